@@ -0,0 +1,89 @@
+"""Measure how long each request holds a pooled database connection.
+
+Times every pool checkout to its checkin while driving login, /users/me and /refresh
+through the ASGI app in-process, and reports checkouts and hold time per request.
+
+Usage: python benchmarks/bench_connection_hold.py [--requests 500]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_hold.db")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+os.environ.setdefault("JWT_SECRET_KEY", "f7bfef017ef0b30c0fa8de9caff04253939b6916b15e47aa2d865db53266eb9a")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+
+import logging
+logging.disable(logging.WARNING)
+
+from httpx import AsyncClient
+from sqlalchemy import event
+
+from database import engine, init_db
+from main import app
+
+
+class HoldTimer:
+    def __init__(self):
+        self.checkouts = 0
+        self.held = 0.0
+        self._started: dict[int, float] = {}
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        self._started[id(connection_record)] = time.perf_counter()
+
+    def checkin(self, dbapi_connection, connection_record):
+        started = self._started.pop(id(connection_record), None)
+        if started is not None:
+            self.held += time.perf_counter() - started
+
+    def reset(self):
+        self.checkouts = 0
+        self.held = 0.0
+
+
+async def main(requests: int) -> None:
+    engine.echo = False
+    await init_db()
+    timer = HoldTimer()
+    event.listen(engine.sync_engine, "checkout", timer.checkout)
+    event.listen(engine.sync_engine, "checkin", timer.checkin)
+
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+        user = {"username": "bench", "password": "password", "email": "bench@example.com"}
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        response = await client.get("/refresh_token", headers=headers)
+        refresh = {"refresh_token": response.json()["refresh_token"]}
+
+        flows = {
+            "POST /token": lambda: client.post("/token", data=user),
+            "GET /users/me": lambda: client.get("/users/me", headers=headers),
+            "POST /refresh": lambda: client.post("/refresh", json=refresh, headers=headers),
+        }
+        print(f"{'request':<16}{'checkouts':>11}{'held ms':>10}{'total ms':>10}")
+        for name, flow in flows.items():
+            # Password hashing makes logins slow; fewer of them are enough
+            count = max(requests // 20, 10) if name == "POST /token" else requests
+            timer.reset()
+            begin = time.perf_counter()
+            for _ in range(count):
+                response = await flow()
+                assert response.status_code == 200, response.status_code
+            total = (time.perf_counter() - begin) / count * 1000
+            print(f"{name:<16}{timer.checkouts / count:>11.1f}{timer.held / count * 1000:>10.2f}{total:>10.2f}")
+    await engine.dispose()
+    os.remove(DB_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
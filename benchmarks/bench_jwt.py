@@ -0,0 +1,47 @@
+"""Compare access token encode/decode throughput of the python-jose and HS256 JWT backends.
+
+Usage: python benchmarks/bench_jwt.py [--iterations 20000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.jwt_backends import HS256Backend, JoseBackend
+
+SECRET_KEY = "f7bfef017ef0b30c0fa8de9caff04253939b6916b15e47aa2d865db53266eb9a"
+
+
+def ops_per_second(fn, iterations: int) -> float:
+    begin = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return iterations / (time.perf_counter() - begin)
+
+def main(iterations: int) -> None:
+    payload = {
+        "sub": "username",
+        "exp": datetime.now(tz=timezone.utc) + timedelta(minutes=30),
+        "uid": 123456,
+        "email": "user@example.com",
+        "ver": 3,
+    }
+    backends = {"jose": JoseBackend(SECRET_KEY, "HS256"), "hs256": HS256Backend(SECRET_KEY)}
+    token = backends["jose"].encode(dict(payload))
+    results = {}
+    print(f"{'backend':<10}{'encode/s':>12}{'decode/s':>12}")
+    for name, backend in backends.items():
+        encode = ops_per_second(lambda: backend.encode(dict(payload)), iterations)
+        decode = ops_per_second(lambda: backend.decode(token), iterations)
+        results[name] = (encode, decode)
+        print(f"{name:<10}{encode:>12.0f}{decode:>12.0f}")
+    print(f"{'speedup':<10}{results['hs256'][0] / results['jose'][0]:>11.1f}x{results['hs256'][1] / results['jose'][1]:>11.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    main(args.iterations)
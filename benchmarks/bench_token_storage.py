@@ -0,0 +1,106 @@
+"""Report table and index sizes for token storage before and after the digest migration.
+
+Loads the legacy layout (raw JWT / UUID strings, text index on the JWT), runs
+database.upgrade_token_digests on it, and reports per-table and per-index sizes
+from SQLite's dbstat virtual table.
+
+Usage: python benchmarks/bench_token_storage.py [--rows 10000000] [--users 1000000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_tokens.db")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+os.environ.setdefault("JWT_SECRET_KEY", "f7bfef017ef0b30c0fa8de9caff04253939b6916b15e47aa2d865db53266eb9a")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+
+from sqlalchemy import create_engine, text
+
+from database import Base, upgrade_token_digests
+from models.user import User
+from models.access_token import AccessToken
+from models.refresh_token import RefreshToken
+from utils.jwt import create_access_token
+
+BATCH_SIZE = 50000
+
+# The schema before the digest migration, as create_all used to emit it
+LEGACY_SCHEMA = [
+    "CREATE TABLE access_tokens (id INTEGER NOT NULL, access_token VARCHAR NOT NULL, expiration_time DATETIME NOT NULL, "
+    "user_id INTEGER NOT NULL, create_time DATETIME NOT NULL, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE)",
+    "CREATE INDEX ix_access_tokens_access_token ON access_tokens (access_token)",
+    "CREATE TABLE refresh_tokens (user_id INTEGER NOT NULL, refresh_token VARCHAR NOT NULL, expiration_time DATETIME NOT NULL, "
+    "create_time DATETIME NOT NULL, PRIMARY KEY (user_id), FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE)",
+]
+
+def populate(conn, rows: int, users: int) -> None:
+    Base.metadata.tables["users"].create(conn)
+    for statement in LEGACY_SCHEMA:
+        conn.execute(text(statement))
+    start = datetime(2024, 1, 1)
+    expires = timedelta(minutes=30)
+    for batch_start in range(0, rows, BATCH_SIZE):
+        batch = []
+        for i in range(batch_start, min(batch_start + BATCH_SIZE, rows)):
+            user_id = i % users + 1
+            issued = start + timedelta(seconds=i)
+            # The same claims the login endpoint issues
+            token = create_access_token(f"user{user_id:08d}", expires, user_id=user_id, email=f"user{user_id}@example.com", version=1)
+            batch.append({"id": i + 1, "access_token": token, "expiration_time": issued + expires, "user_id": user_id, "create_time": issued})
+        conn.execute(text(
+            "INSERT INTO access_tokens (id, access_token, expiration_time, user_id, create_time) "
+            "VALUES (:id, :access_token, :expiration_time, :user_id, :create_time)"
+        ), batch)
+    for batch_start in range(0, users, BATCH_SIZE):
+        batch = [
+            {"user_id": i + 1, "refresh_token": str(uuid.uuid4()), "expiration_time": start + timedelta(days=7), "create_time": start}
+            for i in range(batch_start, min(batch_start + BATCH_SIZE, users))
+        ]
+        conn.execute(text(
+            "INSERT INTO refresh_tokens (user_id, refresh_token, expiration_time, create_time) "
+            "VALUES (:user_id, :refresh_token, :expiration_time, :create_time)"
+        ), batch)
+
+def sizes(conn) -> dict[str, tuple[str, int]]:
+    results = conn.execute(text(
+        "SELECT s.name, m.type, m.tbl_name, sum(s.pgsize) FROM dbstat s JOIN sqlite_master m ON m.name = s.name "
+        "WHERE m.tbl_name IN ('access_tokens', 'refresh_tokens') GROUP BY s.name ORDER BY m.tbl_name, m.type DESC, s.name"
+    ))
+    return {name: (f"{table} {kind}", size) for name, kind, table, size in results}
+
+def report(title: str, measured: dict[str, tuple[str, int]]) -> None:
+    print(title)
+    for name, (kind, size) in measured.items():
+        print(f"  {name:<44}{kind:<22}{size / 2**20:>12.1f} MiB")
+    print(f"  {'total':<66}{sum(size for _, size in measured.values()) / 2**20:>12.1f} MiB")
+
+def main(rows: int, users: int) -> None:
+    engine = create_engine(f"sqlite:///{DB_PATH}")
+    with engine.begin() as conn:
+        conn.execute(text("PRAGMA journal_mode = OFF"))
+        begin = time.perf_counter()
+        populate(conn, rows, users)
+        print(f"loaded {rows} access tokens and {users} refresh tokens in {time.perf_counter() - begin:.0f} s")
+    with engine.connect() as conn:
+        report("before", sizes(conn))
+    with engine.begin() as conn:
+        begin = time.perf_counter()
+        upgrade_token_digests(conn)
+        print(f"migrated in {time.perf_counter() - begin:.0f} s")
+    with engine.connect() as conn:
+        report("after", sizes(conn))
+    engine.dispose()
+    os.remove(DB_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    args = parser.parse_args()
+    main(args.rows, args.users)
@@ -0,0 +1,91 @@
+"""Compare keyset and OFFSET pagination latency for GET /users at page 1 and page 10,000,
+without a filter and with a username prefix that matches every user.
+
+Usage: python benchmarks/bench_user_listing.py [--users 500000] [--page-size 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_users.db")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import Base
+from models.user import User
+from utils.crud import UserCRUD, USER_LIST_ORDERS, sort_expression
+
+
+async def populate(engine, user_count: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    start = datetime(2020, 1, 1)
+    batch_size = 50000
+    for batch_start in range(0, user_count, batch_size):
+        rows = [
+            {
+                "username": f"user{i:08d}",
+                "email": f"user{i}@example.com",
+                "password_hash": "x",
+                "create_time": start + timedelta(seconds=i),
+                "version": 1,
+                "is_admin": False,
+            }
+            for i in range(batch_start, min(batch_start + batch_size, user_count))
+        ]
+        async with engine.begin() as conn:
+            await conn.execute(insert(User), rows)
+
+async def timed(fn, repeat: int = 20) -> float:
+    await fn()
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        await fn()
+    return (time.perf_counter() - begin) / repeat * 1000
+
+async def main(user_count: int, page_size: int) -> None:
+    engine = create_async_engine(os.environ["SQLALCHEMY_DATABASE_URL"])
+    SessionLocal = async_sessionmaker(bind=engine)
+    await populate(engine, user_count)
+    last_page = user_count // page_size
+
+    async with SessionLocal() as db:
+        print(f"{user_count} users, page size {page_size}")
+        print(f"{'order':<12}{'prefix':>8}{'page':>8}{'keyset ms':>12}{'offset ms':>12}")
+        for order, prefix in (("id", None), ("create_time", None), ("username", None), ("username", "user")):
+            columns = [sort_expression(column) for column in USER_LIST_ORDERS[order]]
+            for page in (1, last_page):
+                offset = (page - 1) * page_size
+                after = None
+                if offset:
+                    # The cursor a client would hold after walking to this page
+                    results = await db.execute(select(*columns).order_by(*columns).offset(offset - 1).limit(1))
+                    after = tuple(results.first())
+
+                async def keyset():
+                    await UserCRUD.list_users(db, order=order, limit=page_size, after=after, prefix=prefix)
+
+                async def offset_query():
+                    statement = select(User)
+                    if prefix:
+                        statement = statement.filter(User.username.startswith(prefix, autoescape=True))
+                    await db.execute(statement.order_by(*columns).offset(offset).limit(page_size))
+
+                print(f"{order:<12}{prefix or '-':>8}{page:>8}{await timed(keyset):>12.3f}{await timed(offset_query):>12.3f}")
+                db.expunge_all()
+    await engine.dispose()
+    os.remove(DB_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.page_size))
@@ -0,0 +1,82 @@
+"""Compare per-request latency of the /verify forward-auth endpoint and GET /users/me.
+
+Requests are sent straight to the ASGI app (middleware included, no network or HTTP
+client overhead), with and without JWT_TRUSTED_CLAIMS.
+
+Usage: python benchmarks/bench_verify.py [--requests 5000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_verify.db")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+os.environ.setdefault("JWT_SECRET_KEY", "f7bfef017ef0b30c0fa8de9caff04253939b6916b15e47aa2d865db53266eb9a")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+
+import logging
+logging.disable(logging.WARNING)
+
+from httpx import AsyncClient
+
+from database import engine, init_db
+from main import app
+import routers.user_router
+
+
+async def asgi_get(path: str, headers: list[tuple[bytes, bytes]]) -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": headers, "client": ("127.0.0.1", 1234), "server": ("bench", 80),
+    }
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+async def timed(path: str, headers: list[tuple[bytes, bytes]], requests: int) -> float:
+    for _ in range(100):
+        await asgi_get(path, headers)
+    begin = time.perf_counter()
+    for _ in range(requests):
+        status = await asgi_get(path, headers)
+    assert status == 200, status
+    return (time.perf_counter() - begin) / requests * 1e6
+
+async def main(requests: int) -> None:
+    engine.echo = False
+    await init_db()
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+        user = {"username": "bench", "password": "password", "email": "bench@example.com"}
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        headers = [(b"authorization", f"Bearer {response.json()['access_token']}".encode())]
+
+        print(f"{'mode':<16}{'/users/me us':>14}{'/verify us':>12}{'speedup':>10}")
+        for trusted in (False, True):
+            routers.user_router.JWT_TRUSTED_CLAIMS = trusted
+            me = await timed("/users/me", headers, requests)
+            verify = await timed("/verify", headers, requests)
+            mode = "trusted claims" if trusted else "database"
+            print(f"{mode:<16}{me:>14.0f}{verify:>12.0f}{me / verify:>9.1f}x")
+    await engine.dispose()
+    os.remove(DB_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -1,23 +1,117 @@
+import hashlib
 import os
+from contextlib import asynccontextmanager
 from typing import Annotated
 
+from sqlalchemy import MetaData, Table, inspect, insert, select, text
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import Depends
+from fastapi import Depends, Request
 
 SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL")
 
 engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 
-SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Loaded rows stay usable after a commit, so reads can end their transaction (and return
+# the connection to the pool) before the response is built
+SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 class Base(DeclarativeBase):
     pass
 
-async def init_db():
-    async with engine.begin() as conn:
+# Tables that live only in the shard directory database (see sharding.py)
+class DirectoryBase(DeclarativeBase):
+    pass
+
+# Columns added after the first release; create_all does not alter existing tables
+COLUMN_UPGRADES = [
+    ("users", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("users", "is_admin", "BOOLEAN NOT NULL DEFAULT FALSE"),
+]
+
+def upgrade_columns(conn):
+    inspector = inspect(conn)
+    for table, column, definition in COLUMN_UPGRADES:
+        if column not in {c["name"] for c in inspector.get_columns(table)}:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+# Tables that used to store raw tokens: (table, raw column, digest column)
+TOKEN_DIGEST_UPGRADES = [
+    ("access_tokens", "access_token", "access_token_digest"),
+    ("refresh_tokens", "refresh_token", "refresh_token_digest"),
+]
+TOKEN_COPY_BATCH_SIZE = 10000
+
+def copy_token_digests(conn, legacy: Table, table: Table, raw_column: str, digest_column: str):
+    columns = [column.name for column in table.columns if column.name != digest_column]
+    if conn.dialect.name == "postgresql":
+        conn.execute(insert(table).from_select(
+            columns + [digest_column],
+            select(*[legacy.c[name] for name in columns], text(f"sha256(convert_to({raw_column}, 'UTF8'))"))
+        ))
+        serial = table.autoincrement_column
+        if serial is not None:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', '{serial.name}'), "
+                f"coalesce((SELECT max({serial.name}) FROM {table.name}), 0) + 1, false)"
+            ))
+        return
+    # Other databases have no SHA-256 function, so hash in batches in keyset order
+    key = legacy.c[table.primary_key.columns.values()[0].name]
+    statement = select(*[legacy.c[name] for name in columns], legacy.c[raw_column]).order_by(key).limit(TOKEN_COPY_BATCH_SIZE)
+    last = None
+    while True:
+        rows = conn.execute(statement if last is None else statement.filter(key > last)).all()
+        if not rows:
+            return
+        conn.execute(insert(table), [
+            {**dict(zip(columns, row)), digest_column: hashlib.sha256(row[-1].encode("utf-8")).digest()}
+            for row in rows
+        ])
+        last = getattr(rows[-1], key.name)
+
+def upgrade_token_digests(conn):
+    # Rebuild rather than ALTER so the old text column and its index are not left behind as dead space
+    inspector = inspect(conn)
+    for table_name, raw_column, digest_column in TOKEN_DIGEST_UPGRADES:
+        if raw_column not in {c["name"] for c in inspector.get_columns(table_name)}:
+            continue
+        legacy_name = f"{table_name}_legacy"
+        conn.execute(text(f"ALTER TABLE {table_name} RENAME TO {legacy_name}"))
+        # Index and sequence names are schema-wide, so move them out of the way of the new table
+        for index in inspector.get_indexes(legacy_name):
+            conn.execute(text(f"DROP INDEX {index['name']}"))
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f"ALTER INDEX IF EXISTS {table_name}_pkey RENAME TO {legacy_name}_pkey"))
+            conn.execute(text(f"ALTER SEQUENCE IF EXISTS {table_name}_id_seq RENAME TO {legacy_name}_id_seq"))
+        table = Base.metadata.tables[table_name]
+        table.create(conn)
+        legacy = Table(legacy_name, MetaData(), autoload_with=conn)
+        copy_token_digests(conn, legacy, table, raw_column, digest_column)
+        conn.execute(text(f"DROP TABLE {legacy_name}"))
+        inspector = inspect(conn)
+
+# Indexes dropped since they were released: (table, index)
+OBSOLETE_INDEXES = [
+    ("users", "ix_users_username_pattern"),
+]
+
+def upgrade_indexes(conn):
+    inspector = inspect(conn)
+    for table_name, index_name in OBSOLETE_INDEXES:
+        if index_name in {index["name"] for index in inspector.get_indexes(table_name)}:
+            conn.execute(text(f"DROP INDEX {index_name}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+async def init_db(db_engine=engine):
+    async with db_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_columns)
+        await conn.run_sync(upgrade_token_digests)
+        await conn.run_sync(upgrade_indexes)
 
 async def get_db():
     db = SessionLocal()
@@ -26,4 +120,15 @@ async def get_db():
     finally:
         await db.close()
 
-DatabaseDependency = Annotated[AsyncSession, Depends(get_db)]
\ No newline at end of file
+DatabaseDependency = Annotated[AsyncSession, Depends(get_db)]
+
+@asynccontextmanager
+async def open_db(request: Request):
+    # For dependencies that only sometimes need a session; honours dependency overrides
+    session_dependency = request.app.dependency_overrides.get(get_db, get_db)
+    sessions = session_dependency()
+    db = await sessions.__anext__()
+    try:
+        yield db
+    finally:
+        await sessions.aclose()
\ No newline at end of file
@@ -4,17 +4,23 @@ load_dotenv(override=True)
 import asyncio
 import os
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database import init_db, SessionLocal
+from sharding import SHARD_RETRY_AFTER_SECONDS, ShardMovingError, ShardedSession, sharded_database
 from routers.user_router import user_router
 from routers.auth_router import auth_router
+from routers.metrics_router import metrics_router
+from routers.forward_auth import verify_app
 from utils.crud import TokenCRUD
+from utils.admission import AdmissionControlMiddleware, admission_controller
+from utils.audit import audit_log
 
 
-async def periodic_token_cleanup(db: AsyncSession):
+async def periodic_token_cleanup(db: AsyncSession | ShardedSession):
     token_cleanup_interval = os.environ.get("TOKEN_CLEANUP_MINUTES", 60)
     while True:
         await TokenCRUD.delete_expired_access_tokens(db)
@@ -24,16 +30,33 @@ async def periodic_token_cleanup(db: AsyncSession):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
-    db = SessionLocal()
+    if sharded_database is not None:
+        await sharded_database.init()
+    await audit_log.start()
+    db = SessionLocal() if sharded_database is None else ShardedSession(sharded_database)
     task = asyncio.create_task(periodic_token_cleanup(db))
     yield
     task.cancel()
     await db.close()
+    await audit_log.stop()
+    if sharded_database is not None:
+        await sharded_database.dispose()
         
 app = FastAPI(lifespan=lifespan)
 app.include_router(user_router)
 app.include_router(auth_router)
+app.include_router(metrics_router)
+# Plain ASGI endpoint, outside FastAPI's dependency injection and validation. Mounted as a prefix
+# too, since Envoy's ext_authz calls /verify/<original path> with the original method.
+app.add_route("/verify", verify_app, include_in_schema=False)
+app.mount("/verify", verify_app)
+app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
 
+@app.exception_handler(ShardMovingError)
+async def shard_moving_handler(request: Request, exc: ShardMovingError):
+    return JSONResponse(status_code=503, content={"detail": "Temporarily Unavailable"}, headers={"Retry-After": str(SHARD_RETRY_AFTER_SECONDS)})
+
+# async so it never waits for a threadpool slot behind password hashing
 @app.get("/livenessProbe")
-def health_check():
+async def health_check():
     return {"status": "Running"}
\ No newline at end of file
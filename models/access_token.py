@@ -1,13 +1,16 @@
 from datetime import datetime
 
 from database import Base
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column
 
 class AccessToken(Base):
     __tablename__ = "access_tokens"
+    # Fixed-width columns first so rows pack without alignment padding
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    access_token: Mapped[str] = mapped_column(index=True, nullable=False)
-    expiration_time: Mapped[datetime] = mapped_column(nullable=False)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
-    create_time: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
\ No newline at end of file
+    expiration_time: Mapped[datetime] = mapped_column(nullable=False)
+    create_time: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
+    access_token_digest: Mapped[bytes] = mapped_column(LargeBinary(32), index=True, nullable=False)
+    # Only the digest is stored; the raw token is set on instances created by this process
+    access_token = None
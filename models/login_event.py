@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from database import Base
+from sqlalchemy import Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+class LoginEvent(Base):
+    __tablename__ = "login_events"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    event: Mapped[str] = mapped_column(nullable=False)
+    user_id: Mapped[int] = mapped_column(nullable=True)
+    username: Mapped[str] = mapped_column(nullable=False)
+    source_ip: Mapped[str] = mapped_column(nullable=True)
+    create_time: Mapped[datetime] = mapped_column(nullable=False)
+    __table_args__ = (Index("ix_login_events_user_id_create_time", "user_id", "create_time"),)
@@ -0,0 +1,9 @@
+from database import DirectoryBase
+from sqlalchemy.orm import Mapped, mapped_column
+
+class ShardBucket(DirectoryBase):
+    __tablename__ = "shard_buckets"
+    bucket: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    shard: Mapped[int] = mapped_column(nullable=False)
+    # Writes to a moving bucket are refused until resharding finishes with it
+    moving: Mapped[bool] = mapped_column(default=False, nullable=False)
@@ -1,6 +1,7 @@
 from datetime import datetime
 
 from database import Base
+from sqlalchemy import Index, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 class User(Base):
@@ -10,4 +11,12 @@ class User(Base):
     email: Mapped[str] = mapped_column(default="")
     password_hash: Mapped[str] = mapped_column(nullable=False)
     create_time: Mapped[datetime] = mapped_column(default=datetime.utcnow, nullable=False)
-    last_update_time: Mapped[datetime] = mapped_column(nullable=True, default=None, onupdate=datetime.utcnow)
\ No newline at end of file
+    version: Mapped[int] = mapped_column(default=1, server_default="1", nullable=False)
+    is_admin: Mapped[bool] = mapped_column(default=False, server_default="0", nullable=False)
+    last_update_time: Mapped[datetime] = mapped_column(nullable=True, default=None, onupdate=datetime.utcnow)
+    __table_args__ = (
+        # Keyset pagination by (create_time, id), and by username in bytewise order with prefix search.
+        # Other databases already compare text bytewise, so the unique username index serves there.
+        Index("ix_users_create_time_id", "create_time", "id"),
+        Index("ix_users_username_bytewise", text('username COLLATE "C"')).ddl_if(dialect="postgresql"),
+    )
\ No newline at end of file
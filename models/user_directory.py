@@ -0,0 +1,10 @@
+from database import DirectoryBase
+from sqlalchemy.orm import Mapped, mapped_column
+
+class UserDirectory(DirectoryBase):
+    __tablename__ = "user_directory"
+    # Allocates user ids and keeps usernames unique across all shards
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    username: Mapped[str] = mapped_column(unique=True, nullable=False)
+    # Set in the same transaction as the insert, once the id is known
+    bucket: Mapped[int] = mapped_column(index=True, nullable=True)
@@ -1,17 +1,20 @@
+import hmac
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 
-from database import DatabaseDependency
+from sharding import ShardedDatabaseDependency, ShardedSession
 from models.user import User
 from schemas.token_schemas import JWTToken, TokenCreate, RefreshToken, RefreshEndpointInput
 from schemas.util_schemas import ExceptionMessage
-from utils.crud import UserCRUD, TokenCRUD
+from utils.crud import UserCRUD, TokenCRUD, unit_of_work
+from utils.audit import AuditEventType, audit_log
 from utils.password_utils import verify_password
-from utils.jwt import create_access_token, create_refresh_token, TokenDependency
+from utils.jwt import create_user_access_token, create_refresh_token, token_digest, TokenDependency
 from routers.user_router import get_current_user
 
 auth_router = APIRouter(
@@ -19,24 +22,31 @@ auth_router = APIRouter(
     tags=["authentication"]
 )
 
-async def authenticate_user(username: str, password: str, db: AsyncSession) -> User | None:
+def get_source_ip(request: Request) -> str | None:
+    return request.client.host if request.client else None
+
+async def authenticate_user(username: str, password: str, db: AsyncSession | ShardedSession, source_ip: str | None = None) -> User | None:
     user = await UserCRUD.get_user_by_username(db, username)
     if not user:
+        audit_log.record(AuditEventType.LOGIN_FAILURE, username, source_ip=source_ip)
         return None
-    if not verify_password(password, user.password_hash):
+    if not await run_in_threadpool(verify_password, password, user.password_hash):
+        audit_log.record(AuditEventType.LOGIN_FAILURE, username, user_id=user.id, source_ip=source_ip)
         return None
+    audit_log.record(AuditEventType.LOGIN_SUCCESS, username, user_id=user.id, source_ip=source_ip)
     return user
 
 @auth_router.post("/token", responses={401: {"model": ExceptionMessage}})
 async def generate_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()], 
-    db: DatabaseDependency
+    db: ShardedDatabaseDependency,
+    request: Request
 ) -> JWTToken:
-    user = await authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db, get_source_ip(request))
     if user is None:
         raise HTTPException(status_code=401, detail="Invalid Credentials")
 
-    access_token = create_access_token(user.username)
+    access_token = create_user_access_token(user)
     token = TokenCreate(
         token=access_token, 
         user_id=user.id
@@ -44,30 +54,41 @@ async def generate_access_token(
     return await TokenCRUD.create_access_token(db, token)
 
 @auth_router.get("/refresh_token", responses={401: {"model": ExceptionMessage}})
-async def generate_refresh_token(token: TokenDependency, db: DatabaseDependency) -> RefreshToken:
+async def generate_refresh_token(token: TokenDependency, db: ShardedDatabaseDependency, request: Request) -> RefreshToken:
     user = await get_current_user(token, db)
+    # Read before committing; the commit (or rollback) expires the loaded user
+    user_id, username = user.id, user.username
     refresh_token = create_refresh_token()
     token = TokenCreate(
         token=refresh_token,
-        user_id=user.id
+        user_id=user_id
     )
     try:
         db_token = await TokenCRUD.create_refresh_token(db, token)
     except IntegrityError:
         await db.rollback()
         db_token = await TokenCRUD.update_refresh_token(db, token)
+    audit_log.record(AuditEventType.REFRESH_TOKEN_ISSUED, username, user_id=user_id, source_ip=get_source_ip(request))
     return db_token
 
 @auth_router.post("/refresh", responses={401: {"model": ExceptionMessage}})
-async def generate_access_token_with_refresh_token(refresh_token: RefreshEndpointInput, token: TokenDependency, db: DatabaseDependency) -> JWTToken:
-    user = await get_current_user(token, db)
-    db_token = await TokenCRUD.get_refresh_token_by_userid(db, user.id)
-    if db_token is None or db_token.refresh_token != refresh_token.refresh_token:
-        raise HTTPException(status_code=401, detail="Invalid Credentials")
-    
-    access_token = create_access_token(user.username)
-    token = TokenCreate(
-        token=access_token, 
-        user_id=user.id
-    )
-    return await TokenCRUD.create_access_token(db, token)
\ No newline at end of file
+async def generate_access_token_with_refresh_token(
+    refresh_token: RefreshEndpointInput, 
+    token: TokenDependency, 
+    db: ShardedDatabaseDependency, 
+    request: Request
+) -> JWTToken:
+    # One short transaction: user lookup, refresh token check and access token insert
+    async with unit_of_work(db):
+        user = await get_current_user(token, db)
+        token = TokenCreate(
+            token=create_user_access_token(user), 
+            user_id=user.id
+        )
+        db_token = await TokenCRUD.get_refresh_token_by_userid(db, user.id)
+        if db_token is None or not hmac.compare_digest(db_token.refresh_token_digest, token_digest(refresh_token.refresh_token)):
+            audit_log.record(AuditEventType.REFRESH_FAILURE, user.username, user_id=user.id, source_ip=get_source_ip(request))
+            raise HTTPException(status_code=401, detail="Invalid Credentials")
+        new_token = await TokenCRUD.create_access_token(db, token)
+    audit_log.record(AuditEventType.REFRESH_SUCCESS, user.username, user_id=user.id, source_ip=get_source_ip(request))
+    return new_token
\ No newline at end of file
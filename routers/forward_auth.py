@@ -0,0 +1,52 @@
+from urllib.parse import quote
+
+from jose import JWTError
+from starlette.requests import Request
+
+from routers.user_router import authenticate_claims
+from utils.jwt import decode_token
+
+
+def bearer_token(scope) -> str | None:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token.strip():
+                return token.strip()
+            return None
+    return None
+
+def identity_headers(user_id: int, username: str, email: str) -> list[tuple[bytes, bytes]]:
+    # Percent-encoded so a username or email can never inject header syntax
+    return [
+        (b"x-user-id", str(user_id).encode()),
+        (b"x-user-name", quote(username, safe="@.+").encode()),
+        (b"x-user-email", quote(email or "", safe="@.+").encode()),
+    ]
+
+async def verify_identity(token: str, request: Request) -> tuple[int, str, str] | None:
+    # Same acceptance rules as /users/me, without the dependency injection and pydantic layers
+    try:
+        claims = decode_token(token)
+    except JWTError:
+        return None
+    user = await authenticate_claims(claims, request)
+    if user is None:
+        return None
+    return user.id, user.username, user.email
+
+
+class ForwardAuthApp:
+    # Bare ASGI endpoint for nginx auth_request and Envoy ext_authz: 200 with identity headers or 401
+    async def __call__(self, scope, receive, send):
+        token = bearer_token(scope)
+        identity = await verify_identity(token, Request(scope)) if token else None
+        if identity is None:
+            status, headers = 401, [(b"www-authenticate", b"Bearer")]
+        else:
+            status, headers = 200, identity_headers(*identity)
+        headers.append((b"content-length", b"0"))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+
+verify_app = ForwardAuthApp()
@@ -0,0 +1,35 @@
+import os
+import secrets
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from utils.admission import admission_controller
+from utils.audit import audit_log
+from utils.crud import lookup_flight
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+def verify_metrics_token(x_metrics_token: Annotated[str | None, Header()] = None) -> None:
+    # Metrics stay hidden unless METRICS_TOKEN is configured and presented
+    if not METRICS_TOKEN or x_metrics_token is None or not secrets.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+metrics_router = APIRouter(
+    prefix="",
+    tags=["metrics"],
+    include_in_schema=False,
+    dependencies=[Depends(verify_metrics_token)]
+)
+
+@metrics_router.get("/admissionMetrics")
+def admission_metrics():
+    return admission_controller.metrics()
+
+@metrics_router.get("/lookupMetrics")
+def lookup_metrics():
+    return lookup_flight.metrics()
+
+@metrics_router.get("/auditMetrics")
+def audit_metrics():
+    return audit_log.metrics()
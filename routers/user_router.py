@@ -1,14 +1,19 @@
-from typing import Annotated
+from typing import Annotated, Literal
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import DatabaseDependency
+from sharding import ShardedDatabaseDependency, ShardedSession, open_sharded_db
 from models.user import User as DB_User
-from schemas.user_schemas import User, UserCreate, UserUpdate
+from schemas.user_schemas import User, UserCreate, UserUpdate, UserPage, UserSummary
+from schemas.audit_schemas import LoginEvent
 from schemas.util_schemas import ExceptionMessage
-from utils.crud import UserCRUD
-from utils.jwt import TokenDependency, get_jwt_username
+from utils.crud import UserCRUD, USER_LIST_ORDERS
+from utils.pagination import InvalidCursor, encode_cursor, decode_cursor
+from utils.audit import audit_log, event_time
+from utils.profile_cache import etag_matches, profile_cache, profile_etag
+from utils.jwt import TokenDependency, JWT_TRUSTED_CLAIMS, get_jwt_claims, user_versions
 
 
 user_router = APIRouter(
@@ -16,27 +21,103 @@ user_router = APIRouter(
     tags=["uesr"]
 )
 
-async def get_current_user(token: TokenDependency, db: DatabaseDependency) -> User:
-    username = get_jwt_username(token)
-    user = await UserCRUD.get_user_by_username(db, username=username)
+# Token acceptance rules, shared by the dependencies below and the /verify endpoint
+TRUSTED_IDENTITY_CLAIMS = ("uid", "sub", "email", "ver")
+
+async def find_claims_user(db: AsyncSession | ShardedSession, claims: dict) -> DB_User | None:
+    if "uid" in claims:
+        user = await UserCRUD.get_user_by_id(db, user_id=claims["uid"])
+    else:
+        user = await UserCRUD.get_user_by_username(db, username=claims.get("sub"))
+    if user is None or ("ver" in claims and claims["ver"] != user.version):
+        return None
+    return user
+
+async def authenticate_claims(claims: dict, request: Request) -> DB_User | None:
+    # With JWT_TRUSTED_CLAIMS, a token carrying the whole identity is accepted without a database
+    # session unless this process has seen the profile change since the token was minted
+    if JWT_TRUSTED_CLAIMS and all(claim in claims for claim in TRUSTED_IDENTITY_CLAIMS):
+        if not user_versions.is_current(claims["uid"], claims["ver"]):
+            return None
+        # Transient, never added to a session
+        return DB_User(id=claims["uid"], username=claims["sub"], email=claims["email"], version=claims["ver"])
+    async with open_sharded_db(request) as db:
+        return await find_claims_user(db, claims)
+
+async def get_current_user(token: TokenDependency, db: ShardedDatabaseDependency) -> User:
+    user = await find_claims_user(db, get_jwt_claims(token))
     if user is None:
         raise HTTPException(status_code=401, detail="Invalid Credentials")
     return user
 JWT_USER_DEPENDENCY = Annotated[DB_User, Depends(get_current_user)]
 
-@user_router.get("/me", responses={401: {"model": ExceptionMessage}})
-async def get_user(user: JWT_USER_DEPENDENCY) -> User:
+async def get_token_user(token: TokenDependency, request: Request) -> DB_User:
+    user = await authenticate_claims(get_jwt_claims(token), request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Invalid Credentials")
+    return user
+TOKEN_USER_DEPENDENCY = Annotated[DB_User, Depends(get_token_user)]
+
+async def get_admin_user(user: JWT_USER_DEPENDENCY) -> DB_User:
+    if not user.is_admin:
+        raise HTTPException(status_code=403, detail="Forbidden")
     return user
+ADMIN_USER_DEPENDENCY = Annotated[DB_User, Depends(get_admin_user)]
+
+@user_router.get("", responses={400: {"model": ExceptionMessage}, 401: {"model": ExceptionMessage}, 403: {"model": ExceptionMessage}})
+async def list_users(
+    admin: ADMIN_USER_DEPENDENCY,
+    db: ShardedDatabaseDependency,
+    order: Literal["id", "create_time", "username"] | None = None,
+    prefix: Annotated[str | None, Query(min_length=1)] = None,
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+    cursor: str | None = None
+) -> UserPage:
+    # Prefix search walks the username index, so it is always ordered by username
+    if prefix and order not in (None, "username"):
+        raise HTTPException(status_code=400, detail="Prefix Search Requires Username Order")
+    order = order or ("username" if prefix else "id")
+    try:
+        after = decode_cursor(cursor, order, prefix) if cursor else None
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
+    users = await UserCRUD.list_users(db, order=order, limit=limit + 1, after=after, prefix=prefix)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        key = tuple(getattr(users[-1], column.key) for column in USER_LIST_ORDERS[order])
+        next_cursor = encode_cursor(order, prefix, key)
+    return UserPage(users=[UserSummary.model_validate(user) for user in users], next_cursor=next_cursor)
+
+@user_router.get("/me", response_model=User, responses={304: {"description": "Not Modified"}, 401: {"model": ExceptionMessage}})
+async def get_user(user: TOKEN_USER_DEPENDENCY, request: Request) -> Response:
+    etag = profile_etag(user.id, user.version)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    body = profile_cache.get(user.id, user.version)
+    if body is None:
+        body = User.model_validate(user).model_dump_json().encode()
+        profile_cache.put(user.id, user.version, body)
+    return Response(body, media_type="application/json", headers=headers)
+
+@user_router.get("/me/logins", responses={401: {"model": ExceptionMessage}})
+async def get_user_logins(user: JWT_USER_DEPENDENCY, limit: Annotated[int, Query(ge=1, le=100)] = 20) -> list[LoginEvent]:
+    events = await audit_log.recent_events(user.id, limit)
+    return [
+        LoginEvent(event=event["event"], username=event["username"], source_ip=event["source_ip"], time=event_time(event["time"]))
+        for event in events
+    ]
 
 @user_router.post("", status_code= 201, responses={409: {"model": ExceptionMessage}})
-async def create_user(user: UserCreate, db: DatabaseDependency) -> User:
+async def create_user(user: UserCreate, db: ShardedDatabaseDependency) -> User:
     try:
         return await UserCRUD.create_user(db, user)
     except IntegrityError:
         raise HTTPException(status_code=409, detail="Username Already Exists")
 
 @user_router.put("", responses = {401: {"model": ExceptionMessage}, 409: {"model": ExceptionMessage}})
-async def update_user(updates: UserUpdate, user: JWT_USER_DEPENDENCY, db: DatabaseDependency) -> User:
+async def update_user(updates: UserUpdate, user: JWT_USER_DEPENDENCY, db: ShardedDatabaseDependency) -> User:
     try:
         result = await UserCRUD.update_user(db, user.id, updates)
     except IntegrityError:
@@ -44,5 +125,5 @@ async def update_user(updates: UserUpdate, user: JWT_USER_DEPENDENCY, db: Databa
     return result
 
 @user_router.delete("", status_code=204)
-async def delete_user(user: JWT_USER_DEPENDENCY, db: DatabaseDependency) -> None:
+async def delete_user(user: JWT_USER_DEPENDENCY, db: ShardedDatabaseDependency) -> None:
     await UserCRUD.delete_user_by_username(db, user.username)
\ No newline at end of file
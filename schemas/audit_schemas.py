@@ -0,0 +1,10 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class LoginEvent(BaseModel):
+    event: str
+    username: str
+    source_ip: str | None = None
+    time: datetime
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from pydantic import BaseModel, EmailStr
 
 
@@ -18,4 +20,12 @@ class User(UserBase):
     model_config = {"from_attributes": True}
 
 class UserLogin(UserBase):
-    password: str
\ No newline at end of file
+    password: str
+
+class UserSummary(User):
+    id: int
+    create_time: datetime
+
+class UserPage(BaseModel):
+    users: list[UserSummary]
+    next_cursor: str | None = None
\ No newline at end of file
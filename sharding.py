@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+from fastapi import Depends, Request
+from sqlalchemy import delete, func, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from database import DirectoryBase, SQLALCHEMY_DATABASE_URL, init_db, open_db
+from models.user import User
+from models.access_token import AccessToken
+from models.refresh_token import RefreshToken
+from models.user_directory import UserDirectory
+from models.shard_bucket import ShardBucket
+from utils.singleflight import SingleFlight
+
+SHARD_DATABASE_URLS = [url.strip() for url in os.environ.get("SHARD_DATABASE_URLS", "").split(",") if url.strip()]
+SHARD_DIRECTORY_DATABASE_URL = os.environ.get("SHARD_DIRECTORY_DATABASE_URL", SQLALCHEMY_DATABASE_URL)
+SHARD_BUCKETS = int(os.environ.get("SHARD_BUCKETS", 1024))
+SHARD_MAP_REFRESH_SECONDS = float(os.environ.get("SHARD_MAP_REFRESH_SECONDS", 5))
+SHARD_RETRY_AFTER_SECONDS = int(os.environ.get("SHARD_RETRY_AFTER_SECONDS", 5))
+RESHARD_BATCH_SIZE = 500
+
+# Per-user tables moved together when a bucket changes shards: (table, user id column, columns not copied)
+RESHARDED_TABLES = [
+    (User.__table__, User.__table__.c.id, ()),
+    # Access token ids come from each shard's own sequence
+    (AccessToken.__table__, AccessToken.__table__.c.user_id, ("id",)),
+    (RefreshToken.__table__, RefreshToken.__table__.c.user_id, ()),
+]
+
+
+class ShardMovingError(Exception):
+    pass
+
+
+def shard_bucket(user_id: int, buckets: int = SHARD_BUCKETS) -> int:
+    # Stable across processes and restarts, unlike hash()
+    digest = hashlib.sha256(str(user_id).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % buckets
+
+
+async def max_user_id(engine) -> int | None:
+    async with engine.connect() as conn:
+        return await conn.scalar(select(func.max(User.id)))
+
+async def import_users(db: AsyncSession, engine, buckets: int) -> None:
+    statement = select(User.id, User.username).order_by(User.id).limit(RESHARD_BATCH_SIZE)
+    last = None
+    async with engine.connect() as conn:
+        while True:
+            results = await conn.execute(statement if last is None else statement.filter(User.id > last))
+            rows = results.all()
+            if not rows:
+                break
+            await db.execute(insert(UserDirectory), [
+                {"id": user_id, "username": username, "bucket": shard_bucket(user_id, buckets)}
+                for user_id, username in rows
+            ])
+            last = rows[-1].id
+    if db.get_bind().dialect.name == "postgresql":
+        # Ids allocated from now on must not collide with the adopted users
+        await db.execute(text(
+            "SELECT setval(pg_get_serial_sequence('user_directory', 'id'), "
+            "coalesce((SELECT max(id) FROM user_directory), 0) + 1, false)"
+        ))
+
+
+class ShardedDatabase:
+    # Users are spread over fixed hash buckets of their id; the directory database maps each
+    # bucket to a shard, allocates user ids and keeps usernames globally unique.
+    def __init__(
+        self,
+        shard_urls: list[str],
+        directory_url: str,
+        buckets: int = SHARD_BUCKETS,
+        map_refresh_seconds: float = SHARD_MAP_REFRESH_SECONDS
+    ):
+        self.engines = [create_async_engine(url) for url in shard_urls]
+        self.sessionmakers = [async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine) for engine in self.engines]
+        self.directory_engine = create_async_engine(directory_url)
+        self.directory_sessionmaker = async_sessionmaker(autocommit=False, autoflush=False, bind=self.directory_engine)
+        self.buckets = buckets
+        self.map_refresh_seconds = map_refresh_seconds
+        self._shards: list[int] = []
+        self._moving: set[int] = set()
+        self._loaded_at: float | None = None
+        self._map_flight = SingleFlight()
+
+    async def init(self) -> None:
+        for engine in self.engines:
+            await init_db(engine)
+        async with self.directory_engine.begin() as conn:
+            await conn.run_sync(DirectoryBase.metadata.create_all)
+        async with self.directory_sessionmaker() as db:
+            if await db.scalar(select(ShardBucket.bucket).limit(1)) is None:
+                await self.seed_directory(db)
+                try:
+                    await db.commit()
+                except IntegrityError:
+                    # Another worker seeded the map first
+                    await db.rollback()
+        await self.load_map()
+        await self.check_directory()
+
+    async def seed_directory(self, db: AsyncSession) -> None:
+        # First sharded start. A database that already has users, e.g. the single database being
+        # turned into shard 0, is adopted: its users are registered in the directory and every
+        # bucket stays on it until `python sharding.py` spreads them out.
+        populated = [shard for shard, engine in enumerate(self.engines) if await max_user_id(engine) is not None]
+        if len(populated) > 1:
+            raise RuntimeError("More than one shard already has users; only one existing database can be adopted")
+        for bucket in range(self.buckets):
+            db.add(ShardBucket(bucket=bucket, shard=populated[0] if populated else bucket % len(self.engines)))
+        if populated:
+            await import_users(db, self.engines[populated[0]], self.buckets)
+
+    async def check_directory(self) -> None:
+        # A shard holding users the directory never registered would lose them and hand out
+        # colliding ids, e.g. an existing database added to SHARD_DATABASE_URLS after the first start
+        for shard, engine in enumerate(self.engines):
+            user_id = await max_user_id(engine)
+            async with self.directory_sessionmaker() as db:
+                if user_id is not None and await db.get(UserDirectory, user_id) is None:
+                    raise RuntimeError(f"Shard {shard} has users missing from the shard directory")
+
+    async def dispose(self) -> None:
+        for engine in self.engines:
+            await engine.dispose()
+        await self.directory_engine.dispose()
+
+    async def load_map(self) -> None:
+        async with self.directory_sessionmaker() as db:
+            results = await db.execute(select(ShardBucket).order_by(ShardBucket.bucket))
+            rows = results.scalars().all()
+        if any(row.shard >= len(self.engines) for row in rows):
+            raise ValueError("The shard map references a shard missing from SHARD_DATABASE_URLS")
+        # The directory is authoritative for the bucket count
+        self.buckets = len(rows)
+        self._shards = [row.shard for row in rows]
+        self._moving = {row.bucket for row in rows if row.moving}
+        self._loaded_at = time.monotonic()
+
+    async def refresh_map(self) -> None:
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.map_refresh_seconds:
+            await self._map_flight.do("map", self.load_map)
+
+    def bucket_shards(self) -> list[int]:
+        return list(self._shards)
+
+    def shard_for_user_id(self, user_id: int, write: bool = False) -> int:
+        bucket = shard_bucket(user_id, self.buckets)
+        if write and bucket in self._moving:
+            raise ShardMovingError(f"Bucket {bucket} is being resharded")
+        return self._shards[bucket]
+
+    async def allocate_user_id(self, username: str) -> int:
+        # Raises IntegrityError when the username is taken on any shard
+        async with self.directory_sessionmaker() as db:
+            entry = UserDirectory(username=username)
+            db.add(entry)
+            await db.flush()
+            user_id = entry.id
+            entry.bucket = shard_bucket(user_id, self.buckets)
+            await db.commit()
+            return user_id
+
+    async def user_id_for_username(self, username: str) -> int | None:
+        async with self.directory_sessionmaker() as db:
+            return await db.scalar(select(UserDirectory.id).filter(UserDirectory.username == username))
+
+    async def rename_user(self, user_id: int, username: str) -> None:
+        async with self.directory_sessionmaker() as db:
+            await db.execute(update(UserDirectory).where(UserDirectory.id == user_id).values(username=username))
+            await db.commit()
+
+    async def release_user_id(self, user_id: int) -> None:
+        async with self.directory_sessionmaker() as db:
+            await db.execute(delete(UserDirectory).where(UserDirectory.id == user_id))
+            await db.commit()
+
+
+class ShardedSession:
+    # Request-scoped; a shard's session is only opened when the request first touches that shard
+    def __init__(self, database: ShardedDatabase):
+        self.database = database
+        # Copied into every shard session opened from now on, like AsyncSession.info
+        self.info: dict = {}
+        self._sessions: dict[int, AsyncSession] = {}
+
+    def session(self, shard: int) -> AsyncSession:
+        if shard not in self._sessions:
+            self._sessions[shard] = self.database.sessionmakers[shard](info=dict(self.info))
+        return self._sessions[shard]
+
+    def open_sessions(self) -> list[AsyncSession]:
+        return list(self._sessions.values())
+
+    async def for_user_id(self, user_id: int, write: bool = False) -> AsyncSession:
+        await self.database.refresh_map()
+        return self.session(self.database.shard_for_user_id(user_id, write))
+
+    async def for_username(self, username: str, write: bool = False) -> AsyncSession | None:
+        user_id = await self.database.user_id_for_username(username)
+        if user_id is None:
+            return None
+        return await self.for_user_id(user_id, write)
+
+    def all_sessions(self) -> list[tuple[int, AsyncSession]]:
+        return [(shard, self.session(shard)) for shard in range(len(self.database.engines))]
+
+    async def rollback(self) -> None:
+        for session in self._sessions.values():
+            await session.rollback()
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+sharded_database = ShardedDatabase(SHARD_DATABASE_URLS, SHARD_DIRECTORY_DATABASE_URL) if SHARD_DATABASE_URLS else None
+
+@asynccontextmanager
+async def open_sharded_db(request: Request):
+    # Without SHARD_DATABASE_URLS this is the plain DatabaseDependency session
+    if sharded_database is None:
+        async with open_db(request) as db:
+            yield db
+        return
+    db = ShardedSession(sharded_database)
+    try:
+        yield db
+    finally:
+        await db.close()
+
+async def get_sharded_db(request: Request):
+    async with open_sharded_db(request) as db:
+        yield db
+
+ShardedDatabaseDependency = Annotated[AsyncSession | ShardedSession, Depends(get_sharded_db)]
+
+
+def plan_rebalance(shards: list[int], shard_count: int) -> list[tuple[int, int]]:
+    # Moves the fewest buckets needed to even out the shards, e.g. after adding one
+    owned: list[list[int]] = [[] for _ in range(shard_count)]
+    for bucket, shard in enumerate(shards):
+        owned[shard].append(bucket)
+    quota = [len(shards) // shard_count + (1 if shard < len(shards) % shard_count else 0) for shard in range(shard_count)]
+    surplus = [bucket for shard in range(shard_count) for bucket in owned[shard][quota[shard]:]]
+    moves = []
+    for shard in range(shard_count):
+        for _ in range(quota[shard] - len(owned[shard])):
+            moves.append((surplus.pop(), shard))
+    return moves
+
+async def copy_users(source_engine, target_engine, user_ids: list[int]) -> None:
+    async with source_engine.connect() as source, target_engine.begin() as target:
+        # Clear leftovers of an interrupted move so retrying is safe
+        for table, user_column, _ in reversed(RESHARDED_TABLES):
+            await target.execute(delete(table).where(user_column.in_(user_ids)))
+        for table, user_column, skipped in RESHARDED_TABLES:
+            columns = [column for column in table.columns if column.name not in skipped]
+            results = await source.execute(select(*columns).where(user_column.in_(user_ids)))
+            rows = [dict(row) for row in results.mappings()]
+            if rows:
+                await target.execute(insert(table), rows)
+
+async def delete_users(engine, user_ids: list[int]) -> None:
+    async with engine.begin() as conn:
+        for table, user_column, _ in reversed(RESHARDED_TABLES):
+            await conn.execute(delete(table).where(user_column.in_(user_ids)))
+
+async def move_bucket(database: ShardedDatabase, bucket: int, target: int, grace_seconds: float) -> int:
+    # Online move: writes to the bucket get ShardMovingError (503) while reads continue.
+    # grace_seconds must cover the map refresh interval plus the longest request.
+    async with database.directory_sessionmaker() as db:
+        row = await db.get(ShardBucket, bucket)
+        source = row.shard
+        if source == target:
+            return 0
+        row.moving = True
+        await db.commit()
+    await asyncio.sleep(grace_seconds)
+
+    async with database.directory_sessionmaker() as db:
+        results = await db.execute(select(UserDirectory.id).filter(UserDirectory.bucket == bucket).order_by(UserDirectory.id))
+        user_ids = list(results.scalars().all())
+    batches = [user_ids[start:start + RESHARD_BATCH_SIZE] for start in range(0, len(user_ids), RESHARD_BATCH_SIZE)]
+    for batch in batches:
+        await copy_users(database.engines[source], database.engines[target], batch)
+
+    async with database.directory_sessionmaker() as db:
+        await db.execute(update(ShardBucket).where(ShardBucket.bucket == bucket).values(shard=target))
+        await db.commit()
+    # Keep refusing writes until every process routes the bucket to the target
+    await asyncio.sleep(grace_seconds)
+    async with database.directory_sessionmaker() as db:
+        await db.execute(update(ShardBucket).where(ShardBucket.bucket == bucket).values(moving=False))
+        await db.commit()
+
+    for batch in batches:
+        await delete_users(database.engines[source], batch)
+    return len(user_ids)
+
+async def rebalance(database: ShardedDatabase, grace_seconds: float = 2 * SHARD_MAP_REFRESH_SECONDS) -> int:
+    await database.load_map()
+    moved = 0
+    for bucket, target in plan_rebalance(database.bucket_shards(), len(database.engines)):
+        moved += await move_bucket(database, bucket, target, grace_seconds)
+    await database.load_map()
+    return moved
+
+
+async def main(grace_seconds: float) -> None:
+    if sharded_database is None:
+        raise SystemExit("SHARD_DATABASE_URLS is not set")
+    await sharded_database.init()
+    moved = await rebalance(sharded_database, grace_seconds)
+    print(f"moved {moved} users")
+    await sharded_database.dispose()
+
+if __name__ == "__main__":
+    # Add the new shard's URL to SHARD_DATABASE_URLS everywhere first, then run this once
+    parser = argparse.ArgumentParser(description="Rebalance user buckets across SHARD_DATABASE_URLS")
+    parser.add_argument("--grace-seconds", type=float, default=2 * SHARD_MAP_REFRESH_SECONDS)
+    args = parser.parse_args()
+    asyncio.run(main(args.grace_seconds))
@@ -12,11 +12,14 @@ from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
 from main import app, lifespan
 from database import Base, get_db
+from utils.jwt import user_versions
+from utils.profile_cache import profile_cache
+import routers.user_router
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///test.db"
 engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=False, connect_args={"check_same_thread": False})
-SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 async def mock_get_db():
     db = SessionLocal()
@@ -39,6 +42,8 @@ async def db_setup():
     yield
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
+    user_versions.clear()
+    profile_cache.clear()
 
 @pytest.fixture
 async def db_session():
@@ -48,6 +53,23 @@ async def db_session():
     finally:
         await db.close()
         
+@pytest.fixture
+def trusted_claims():
+    original_value = routers.user_router.JWT_TRUSTED_CLAIMS
+    routers.user_router.JWT_TRUSTED_CLAIMS = True
+    yield
+    routers.user_router.JWT_TRUSTED_CLAIMS = original_value
+
+@pytest.fixture
+def no_db():
+    async def failing_get_db():
+        raise AssertionError("database session opened")
+        yield
+    original_override = app.dependency_overrides[get_db]
+    app.dependency_overrides[get_db] = failing_get_db
+    yield
+    app.dependency_overrides[get_db] = original_override
+
 @pytest.fixture(params=['asyncio'])
 def anyio_backend(request):
     return request.param
\ No newline at end of file
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from env_setup import client, anyio_backend
+from utils.admission import AdmissionController, AdmissionControlMiddleware, ConcurrencyLimiter, Priority
+import routers.metrics_router
+
+
+def build_app(limiter: ConcurrencyLimiter, release: asyncio.Event) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/token")
+    async def slow_login():
+        await release.wait()
+        return {"status": "ok"}
+
+    @app.get("/livenessProbe")
+    async def health_check():
+        return {"status": "Running"}
+
+    controller = AdmissionController(
+        priorities={
+            ("GET", "/livenessProbe"): Priority.CRITICAL,
+            ("POST", "/token"): Priority.EXPENSIVE,
+        },
+        limiters={("POST", "/token"): limiter}
+    )
+    app.add_middleware(AdmissionControlMiddleware, controller=controller, retry_after=3)
+    return app
+
+class TestConcurrencyLimiter:
+    @pytest.mark.anyio
+    async def test_acquire_release(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=1)
+        assert await limiter.acquire() == True
+        assert limiter.metrics()["active"] == 1
+        limiter.release()
+        assert limiter.metrics()["active"] == 0
+        assert limiter.metrics()["admitted"] == 1
+
+    @pytest.mark.anyio
+    async def test_queue_timeout(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=0.01)
+        await limiter.acquire()
+        assert await limiter.acquire() == False
+        assert limiter.metrics()["rejected_timeout"] == 1
+        assert limiter.metrics()["queue_depth"] == 0
+
+    @pytest.mark.anyio
+    async def test_queue_full(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=1)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.metrics()["queue_depth"] == 1
+        assert await limiter.acquire() == False
+        assert limiter.metrics()["rejected_queue_full"] == 1
+        limiter.release()
+        assert await waiter == True
+        assert limiter.metrics()["active"] == 1
+        limiter.release()
+        assert limiter.metrics()["active"] == 0
+
+    @pytest.mark.anyio
+    async def test_timeout_does_not_leak_slots(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=10, queue_timeout=0.01)
+        await limiter.acquire()
+        results = await asyncio.gather(*[limiter.acquire() for _ in range(5)])
+        assert results == [False] * 5
+        limiter.release()
+        assert limiter.metrics()["active"] == 0
+        assert await limiter.acquire() == True
+
+    @pytest.mark.anyio
+    async def test_cancelled_waiter_passes_slot_on(self):
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=10, queue_timeout=1)
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()
+        cancelled.cancel()
+        assert await waiter == True
+        assert cancelled.cancelled()
+        assert limiter.metrics()["active"] == 1
+        assert limiter.metrics()["queue_depth"] == 0
+
+class TestAdmissionController:
+    def test_critical_prefixes(self):
+        controller = AdmissionController(priorities={}, limiters={}, critical_prefixes=("/verify",))
+        assert controller.get_priority("GET", "/verify") is Priority.CRITICAL
+        assert controller.get_priority("POST", "/verify/api/x") is Priority.CRITICAL
+        assert controller.get_priority("GET", "/verifyx") is Priority.NORMAL
+
+class TestAdmissionControlMiddleware:
+    @pytest.mark.anyio
+    async def test_expensive_route_rejected_when_saturated(self):
+        release = asyncio.Event()
+        limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=0, queue_timeout=1)
+        app = build_app(limiter, release)
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            first = asyncio.create_task(ac.post("/token"))
+            while limiter.active == 0:
+                await asyncio.sleep(0.001)
+            response = await ac.post("/token")
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "3"
+
+            response = await ac.get("/livenessProbe")
+            assert response.status_code == 200
+
+            release.set()
+            response = await first
+            assert response.status_code == 200
+        assert limiter.metrics()["rejected_queue_full"] == 1
+        assert limiter.metrics()["active"] == 0
+
+    @pytest.fixture
+    def metrics_token(self):
+        original_value = routers.metrics_router.METRICS_TOKEN
+        routers.metrics_router.METRICS_TOKEN = "metrics"
+        yield "metrics"
+        routers.metrics_router.METRICS_TOKEN = original_value
+
+    @pytest.mark.anyio
+    async def test_admission_metrics_endpoint(self, client, metrics_token):
+        response = await client.get("/admissionMetrics", headers={"X-Metrics-Token": metrics_token})
+        response_data = response.json()
+        assert response.status_code == 200
+        assert "queue_depth" in response_data["POST /token"]
+        assert "rejected_timeout" in response_data["POST /users"]
+        assert "active" in response_data["PUT /users"]
+        assert "active" in response_data["normal"]
+
+    @pytest.mark.anyio
+    async def test_admission_metrics_endpoint_hidden(self, client, metrics_token):
+        response = await client.get("/admissionMetrics")
+        assert response.status_code == 404
+        response = await client.get("/admissionMetrics", headers={"X-Metrics-Token": "wrong"})
+        assert response.status_code == 404
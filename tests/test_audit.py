@@ -0,0 +1,134 @@
+import asyncio
+import os
+
+import pytest
+
+from env_setup import client, db_setup, anyio_backend, SessionLocal
+from utils.audit import AuditEventType, AuditLog, DatabaseSink, SegmentFileSink
+
+
+def make_event(user_id: int, username: str = "test", event: str = "login_success", time: float = 0) -> dict:
+    return {"event": event, "user_id": user_id, "username": username, "source_ip": "127.0.0.1", "time": time}
+
+class TestSegmentFileSink:
+    @pytest.mark.anyio
+    async def test_write_and_query(self, tmp_path):
+        sink = SegmentFileSink(str(tmp_path))
+        sink.open()
+        await sink.write([make_event(1, time=1), make_event(2, time=2), make_event(1, time=3)])
+        events = await sink.recent_events(1, 10)
+        assert [event["time"] for event in events] == [3, 1]
+        assert await sink.recent_events(3, 10) == []
+
+    @pytest.mark.anyio
+    async def test_rotation_and_retention(self, tmp_path):
+        sink = SegmentFileSink(str(tmp_path), segment_max_bytes=200, max_segments=2)
+        sink.open()
+        for i in range(10):
+            await sink.write([make_event(1, time=i)])
+        assert len(os.listdir(tmp_path)) == 2
+        events = await sink.recent_events(1, 10)
+        assert events[0]["time"] == 9
+        assert all(event["time"] >= 6 for event in events)
+
+    @pytest.mark.anyio
+    async def test_reopen_rebuilds_index(self, tmp_path):
+        sink = SegmentFileSink(str(tmp_path))
+        sink.open()
+        await sink.write([make_event(1, time=1), make_event(1, time=2)])
+        with open(os.path.join(tmp_path, "audit-00000001.log"), "ab") as f:
+            f.write(b'{"event":"login_su')
+
+        sink = SegmentFileSink(str(tmp_path))
+        sink.open()
+        events = await sink.recent_events(1, 10)
+        assert [event["time"] for event in events] == [2, 1]
+        await sink.write([make_event(1, time=3)])
+        events = await sink.recent_events(1, 10)
+        assert [event["time"] for event in events] == [3, 2, 1]
+
+class TestAuditLog:
+    @pytest.mark.anyio
+    async def test_recent_events_include_unflushed(self, tmp_path):
+        log = AuditLog(SegmentFileSink(str(tmp_path)), flush_interval=60)
+        await log.start()
+        log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        await log.flush()
+        log.record(AuditEventType.LOGIN_FAILURE, "test", user_id=1)
+        events = await log.recent_events(1)
+        assert [event["event"] for event in events] == ["login_failure", "login_success"]
+        await log.stop()
+        assert len(await log.sink.recent_events(1, 10)) == 2
+
+    @pytest.mark.anyio
+    async def test_flush_on_batch_size(self, tmp_path):
+        log = AuditLog(SegmentFileSink(str(tmp_path)), flush_interval=60, batch_size=2)
+        await log.start()
+        log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        async with asyncio.timeout(5):
+            while log.metrics()["flushed"] < 2:
+                await asyncio.sleep(0.01)
+        assert len(await log.sink.recent_events(1, 10)) == 2
+        await log.stop()
+
+    @pytest.mark.anyio
+    async def test_buffer_limit(self, tmp_path):
+        log = AuditLog(SegmentFileSink(str(tmp_path)), flush_interval=60, max_buffer=2)
+        for _ in range(3):
+            log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        assert log.metrics()["buffered"] == 2
+        assert log.metrics()["dropped"] == 1
+
+    @pytest.mark.anyio
+    async def test_failed_flush_keeps_buffer_bounded(self, tmp_path):
+        sink = SegmentFileSink(str(tmp_path / "missing"))
+        log = AuditLog(sink, flush_interval=60, max_buffer=2)
+        log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        log.record(AuditEventType.LOGIN_SUCCESS, "test", user_id=1)
+        with pytest.raises(OSError):
+            await log.flush()
+        assert log.metrics()["buffered"] == 2
+        assert log.metrics()["flushed"] == 0
+
+    @pytest.mark.anyio
+    async def test_database_sink(self, db_setup):
+        sink = DatabaseSink(SessionLocal)
+        await sink.write([make_event(1, time=1), make_event(2, time=2), make_event(1, time=3)])
+        events = await sink.recent_events(1, 10)
+        assert [event["time"] for event in events] == [3, 1]
+
+class TestLoginHistoryEndpoint:
+    @pytest.mark.anyio
+    async def test_get_user_logins(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        await client.post("/token", data={"username": "test", "password": "wrong_password"})
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me/logins", headers=headers)
+        response_data = response.json()
+        assert response.status_code == 200
+        assert [event["event"] for event in response_data[:2]] == ["login_success", "login_failure"]
+        assert response_data[0]["username"] == "test"
+
+    @pytest.mark.anyio
+    async def test_get_user_logins_invalid_limit(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me/logins", params={"limit": -1}, headers=headers)
+        assert response.status_code == 422
@@ -1,6 +1,13 @@
+from datetime import datetime, timedelta, timezone
+
 import pytest
+from sqlalchemy import update
 
-from env_setup import client, db_setup, anyio_backend
+from env_setup import client, db_setup, db_session, anyio_backend, trusted_claims, no_db
+from models.user import User as DB_User
+from utils.pagination import encode_cursor
+from utils.jwt import create_access_token, jwt_backend
+from utils.admission import admission_controller
 
 class TestUserEndpoints:
     @pytest.mark.anyio
@@ -45,6 +52,82 @@ class TestUserEndpoints:
         assert response_data["username"] == "test"
         assert response_data["email"] == "email@gmail.com"
     
+    @pytest.mark.anyio
+    async def test_get_user_info_username_only_token(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        token = create_access_token("test")
+        
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["username"] == "test"
+    
+    @pytest.mark.anyio
+    async def test_get_user_info_trusted_claims(self, client, db_setup, trusted_claims, no_db):
+        token = create_access_token("test", user_id=1, email="email@gmail.com", version=1)
+        
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me", headers=headers)
+        response_data = response.json()
+        assert response.status_code == 200
+        assert response_data["username"] == "test"
+        assert response_data["email"] == "email@gmail.com"
+    
+    @pytest.mark.anyio
+    async def test_get_user_info_trusted_claims_after_update(self, client, db_setup, trusted_claims):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+        
+        headers = {'Authorization': f'Bearer {token}'}
+        await client.put("/users", json={"email": "email2@gmail.com"}, headers=headers)
+        response = await client.get("/users/me", headers=headers)
+        assert response.status_code == 401
+    
+    @pytest.mark.anyio
+    async def test_get_user_info_conditional(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        headers = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+
+        response = await client.get("/users/me", headers=headers)
+        etag = response.headers["ETag"]
+        assert etag == 'W/"1-1"'
+        response = await client.get("/users/me", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+
+        await client.put("/users", json={"email": "new@gmail.com"}, headers=headers)
+        response = await client.post("/token", data=user)
+        headers = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+        response = await client.get("/users/me", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == 'W/"1-2"'
+        assert response.json()["email"] == "new@gmail.com"
+
+    @pytest.mark.anyio
+    async def test_get_user_info_conditional_trusted_claims(self, client, db_setup, trusted_claims, no_db):
+        token = create_access_token("test", user_id=1, email="email@gmail.com", version=3)
+        headers = {'Authorization': f'Bearer {token}', "If-None-Match": 'W/"1-2", "1-3"'}
+        response = await client.get("/users/me", headers=headers)
+        assert response.status_code == 304
+
     @pytest.mark.anyio
     async def test_get_user_info_unauthorized(self, client, db_setup):
         user = {
@@ -78,6 +161,14 @@ class TestUserEndpoints:
         assert response_data["username"] == "test2"
         assert response_data["email"] == "email2@gmail.com"
         
+        response = await client.get("/users/me", headers=headers)
+        assert response.status_code == 401
+        response = await client.post("/token", data={"username": "test2", "password": "password"})
+        token = response.json()["access_token"]
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me", headers=headers)
+        assert response.json()["username"] == "test2"
+        
     @pytest.mark.anyio
     async def test_update_user_password(self, client, db_setup):
         user = {
@@ -257,4 +348,168 @@ class TestAuthEndpoints:
         
         headers = {'Authorization': f'Bearer {token}'}        
         response = await client.post("/refresh", json= {"refresh_token": "invalid_token"}, headers=headers)
-        assert response.status_code == 401
\ No newline at end of file
+        assert response.status_code == 401
+
+
+class TestUserListingEndpoint:
+    async def create_admin(self, client, db_session) -> dict:
+        admin = {
+            "username": "admin",
+            "password": "password",
+            "email": "admin@gmail.com"
+        }
+        await client.post("/users", json=admin)
+        await db_session.execute(update(DB_User).where(DB_User.username == "admin").values(is_admin=True))
+        await db_session.commit()
+        response = await client.post("/token", data=admin)
+        token = response.json()["access_token"]
+        return {'Authorization': f'Bearer {token}'}
+
+    async def list_all(self, client, headers, **params) -> list[str]:
+        usernames = []
+        cursor = None
+        while True:
+            query = dict(params, limit=2)
+            if cursor:
+                query["cursor"] = cursor
+            response = await client.get("/users", params=query, headers=headers)
+            assert response.status_code == 200
+            response_data = response.json()
+            usernames.extend(user["username"] for user in response_data["users"])
+            cursor = response_data["next_cursor"]
+            if cursor is None:
+                return usernames
+
+    @pytest.mark.anyio
+    async def test_list_users(self, client, db_setup, db_session):
+        headers = await self.create_admin(client, db_session)
+        for username in ["bob", "alice", "al_x", "alan"]:
+            await client.post("/users", json={"username": username, "password": "password", "email": "email@gmail.com"})
+
+        assert await self.list_all(client, headers) == ["admin", "bob", "alice", "al_x", "alan"]
+        assert await self.list_all(client, headers, order="create_time") == ["admin", "bob", "alice", "al_x", "alan"]
+        assert await self.list_all(client, headers, order="username") == ["admin", "al_x", "alan", "alice", "bob"]
+        assert await self.list_all(client, headers, order="username", prefix="al") == ["al_x", "alan", "alice"]
+        assert await self.list_all(client, headers, prefix="al_") == ["al_x"]
+        assert await self.list_all(client, headers, prefix="a") == ["admin", "al_x", "alan", "alice"]
+        assert await self.list_all(client, headers, prefix="AL") == []
+
+    @pytest.mark.anyio
+    async def test_list_users_prefix_requires_username_order(self, client, db_setup, db_session):
+        headers = await self.create_admin(client, db_session)
+        for order in ("id", "create_time"):
+            response = await client.get("/users", params={"prefix": "a", "order": order}, headers=headers)
+            assert response.status_code == 400
+
+    @pytest.mark.anyio
+    async def test_list_users_invalid_cursor(self, client, db_setup, db_session):
+        headers = await self.create_admin(client, db_session)
+        response = await client.get("/users", params={"cursor": "invalid"}, headers=headers)
+        assert response.status_code == 400
+        response = await client.get("/users", params={"cursor": encode_cursor("id", None, (1,)), "order": "username"}, headers=headers)
+        assert response.status_code == 400
+
+    @pytest.mark.anyio
+    async def test_list_users_forbidden(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users", headers=headers)
+        assert response.status_code == 403
+        response = await client.get("/users")
+        assert response.status_code == 401
+
+
+class TestVerifyEndpoint:
+    @pytest.mark.anyio
+    async def test_verify(self, client, db_setup):
+        user = {
+            "username": "test user",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+
+        response = await client.get("/verify", headers={'Authorization': f'Bearer {token}'})
+        assert response.status_code == 200
+        assert response.headers["X-User-Id"] == "1"
+        assert response.headers["X-User-Name"] == "test%20user"
+        assert response.headers["X-User-Email"] == "email@gmail.com"
+        assert response.content == b""
+
+    @pytest.mark.anyio
+    async def test_verify_envoy_path_prefix(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+
+        # Envoy's ext_authz prepends its path_prefix and keeps the original method
+        response = await client.post("/verify/some/path", headers={'Authorization': f'Bearer {token}'})
+        assert response.status_code == 200
+        assert response.headers["X-User-Name"] == "test"
+        response = await client.post("/verify/some/path")
+        assert response.status_code == 401
+        assert admission_controller.get_limiter("POST", "/verify/some/path") is None
+        assert admission_controller.get_limiter("HEAD", "/verify") is None
+
+    @pytest.mark.anyio
+    async def test_verify_unauthorized(self, client, db_setup):
+        for headers in [{}, {'Authorization': 'Bearer invalid_token'}, {'Authorization': 'Basic dGVzdDp0ZXN0'}]:
+            response = await client.get("/verify", headers=headers)
+            assert response.status_code == 401
+            assert response.headers["WWW-Authenticate"] == "Bearer"
+
+    @pytest.mark.anyio
+    async def test_verify_stale_version(self, client, db_setup):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+        headers = {'Authorization': f'Bearer {token}'}
+        await client.put("/users", json={"email": "new@gmail.com"}, headers=headers)
+
+        response = await client.get("/verify", headers=headers)
+        assert response.status_code == 401
+
+    @pytest.mark.anyio
+    async def test_verify_trusted_claims(self, client, db_setup, trusted_claims, no_db):
+        token = create_access_token("test", user_id=7, email="email@gmail.com", version=1)
+        response = await client.get("/verify", headers={'Authorization': f'Bearer {token}'})
+        assert response.status_code == 200
+        assert response.headers["X-User-Id"] == "7"
+
+    @pytest.mark.anyio
+    async def test_verify_same_rules_as_users_me(self, client, db_setup, trusted_claims):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        await client.post("/users", json=user)
+        # Without sub the claims are incomplete, so both endpoints look the user up by id
+        token = jwt_backend.encode({"uid": 1, "email": "email@gmail.com", "ver": 1, "exp": datetime.now(tz=timezone.utc) + timedelta(minutes=5)})
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["username"] == "test"
+        response = await client.get("/verify", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["X-User-Name"] == "test"
@@ -0,0 +1,115 @@
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from jose import jwt
+from jose.exceptions import JWTError
+
+import env_setup
+from utils.jwt_backends import HS256Backend, JoseBackend, create_backend, base64url_encode
+
+SECRET_KEY = "f7bfef017ef0b30c0fa8de9caff04253939b6916b15e47aa2d865db53266eb9a"
+
+
+def random_text(rng: random.Random) -> str:
+    alphabet = string.ascii_letters + string.digits + "._-@ éü€\"\\/\n😀"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+
+def random_payloads(count: int = 200) -> list[dict]:
+    rng = random.Random(1234)
+    payloads = []
+    for _ in range(count):
+        payload = {
+            "sub": random_text(rng),
+            "exp": datetime.now(tz=timezone.utc) + timedelta(seconds=rng.randint(60, 100000))
+        }
+        if rng.random() < 0.7:
+            payload["uid"] = rng.randint(1, 2**40)
+            payload["email"] = random_text(rng)
+            payload["ver"] = rng.randint(1, 1000)
+        payloads.append(payload)
+    return payloads
+
+def decode_result(backend, token: str):
+    try:
+        return backend.decode(token)
+    except JWTError:
+        return "rejected"
+
+def tampered_tokens(token: str) -> list[str]:
+    header, payload, signature = token.split(".")
+    other_header = base64url_encode(b'{"alg":"HS512","typ":"JWT"}').decode()
+    none_header = base64url_encode(b'{"alg":"none","typ":"JWT"}').decode()
+    flipped = "A" if signature[0] != "A" else "B"
+    return [
+        f"{header}.{payload}.{flipped}{signature[1:]}",
+        f"{header}.{payload[:-2]}.{signature}",
+        f"{other_header}.{payload}.{signature}",
+        f"{none_header}.{payload}.",
+        f"{header}.{payload}",
+        f"{header}.{payload}.{signature}.{signature}",
+        token[:-1],
+        "",
+        "invalid_token",
+    ]
+
+class TestHS256Backend:
+    @pytest.fixture
+    def backends(self):
+        return HS256Backend(SECRET_KEY), JoseBackend(SECRET_KEY, "HS256")
+
+    def test_encode_matches_jose(self, backends):
+        fast, jose_backend = backends
+        for payload in random_payloads():
+            assert fast.encode(payload) == jose_backend.encode(dict(payload))
+
+    def test_decode_matches_jose(self, backends):
+        fast, jose_backend = backends
+        for payload in random_payloads():
+            token = jose_backend.encode(dict(payload))
+            assert fast.decode(token) == jose_backend.decode(token)
+
+    def test_tampered_tokens_rejected_by_both(self, backends):
+        fast, jose_backend = backends
+        for payload in random_payloads(20):
+            for token in tampered_tokens(fast.encode(payload)):
+                assert decode_result(fast, token) == "rejected"
+                assert decode_result(jose_backend, token) == "rejected"
+
+    def test_expired_token_rejected_by_both(self, backends):
+        fast, jose_backend = backends
+        token = fast.encode({"sub": "test", "exp": datetime.now(tz=timezone.utc) - timedelta(seconds=5)})
+        assert decode_result(fast, token) == "rejected"
+        assert decode_result(jose_backend, token) == "rejected"
+
+    def test_wrong_key_rejected_by_both(self, backends):
+        fast, jose_backend = backends
+        token = jwt.encode({"sub": "test", "exp": datetime.now(tz=timezone.utc) + timedelta(minutes=1)}, "other", algorithm="HS256")
+        assert decode_result(fast, token) == "rejected"
+        assert decode_result(jose_backend, token) == "rejected"
+
+    def test_strict_claims(self, backends):
+        fast, jose_backend = backends
+        exp = datetime.now(tz=timezone.utc) + timedelta(minutes=1)
+        # Accepted by python-jose, deliberately rejected by the strict validator
+        for payload in [
+            {"sub": "test"},
+            {"sub": "test", "exp": exp, "nbf": exp - timedelta(minutes=2)},
+            {"sub": "test", "exp": exp, "uid": "1"},
+        ]:
+            token = jose_backend.encode(dict(payload))
+            assert decode_result(jose_backend, token) != "rejected"
+            assert decode_result(fast, token) == "rejected"
+
+class TestCreateBackend:
+    def test_auto(self):
+        assert isinstance(create_backend("auto", SECRET_KEY, "HS256"), HS256Backend)
+        assert isinstance(create_backend("auto", SECRET_KEY, "HS512"), JoseBackend)
+
+    def test_explicit(self):
+        assert isinstance(create_backend("jose", SECRET_KEY, "HS256"), JoseBackend)
+        with pytest.raises(ValueError):
+            create_backend("hs256", SECRET_KEY, "HS512")
+        with pytest.raises(ValueError):
+            create_backend("hs265", SECRET_KEY, "HS256")
@@ -0,0 +1,282 @@
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from env_setup import client, anyio_backend
+from models.user import User
+from models.shard_bucket import ShardBucket
+from models.user_directory import UserDirectory
+from schemas.token_schemas import TokenCreate
+from schemas.user_schemas import UserCreate, UserUpdate
+from sharding import ShardedDatabase, ShardedSession, ShardMovingError, copy_users, move_bucket, plan_rebalance, rebalance, shard_bucket
+from utils.crud import UserCRUD, TokenCRUD
+from utils.jwt import token_digest
+import sharding
+
+
+def sqlite_url(path, name: str) -> str:
+    return f"sqlite+aiosqlite:///{path / name}.db"
+
+async def open_sharded_database(path, shard_count: int, buckets: int = 16) -> ShardedDatabase:
+    database = ShardedDatabase(
+        [sqlite_url(path, f"shard{shard}") for shard in range(shard_count)],
+        sqlite_url(path, "directory"),
+        buckets=buckets,
+        map_refresh_seconds=0
+    )
+    await database.init()
+    return database
+
+async def shard_user_counts(database: ShardedDatabase) -> list[int]:
+    counts = []
+    for sessionmaker in database.sessionmakers:
+        async with sessionmaker() as db:
+            counts.append(await db.scalar(select(func.count()).select_from(User)))
+    return counts
+
+async def set_moving(database: ShardedDatabase, moving: bool, *buckets: int) -> None:
+    async with database.directory_sessionmaker() as db:
+        await db.execute(update(ShardBucket).where(ShardBucket.bucket.in_(buckets)).values(moving=moving))
+        await db.commit()
+
+async def create_users(database: ShardedDatabase, count: int) -> None:
+    db = ShardedSession(database)
+    for i in range(count):
+        await UserCRUD.create_user(db, UserCreate(username=f"user{i}", password="password", email="email@gmail.com"))
+    await db.close()
+
+@pytest.fixture
+async def sharded(tmp_path):
+    database = await open_sharded_database(tmp_path, 3)
+    yield database
+    await database.dispose()
+
+class TestShardedCRUD:
+    @pytest.mark.anyio
+    async def test_users_spread_and_found(self, sharded):
+        await create_users(sharded, 20)
+        counts = await shard_user_counts(sharded)
+        assert sum(counts) == 20
+        assert all(count > 0 for count in counts)
+
+        db = ShardedSession(sharded)
+        user = await UserCRUD.get_user_by_username(db, "user7")
+        assert user.username == "user7"
+        assert (await UserCRUD.get_user_by_id(db, user.id)).username == "user7"
+        assert await UserCRUD.get_user_by_username(db, "missing") is None
+        await db.close()
+
+    @pytest.mark.anyio
+    async def test_username_unique_across_shards(self, sharded):
+        await create_users(sharded, 2)
+        db = ShardedSession(sharded)
+        with pytest.raises(IntegrityError):
+            await UserCRUD.create_user(db, UserCreate(username="user1", password="password", email="email@gmail.com"))
+        user = await UserCRUD.get_user_by_username(db, "user0")
+        with pytest.raises(IntegrityError):
+            await UserCRUD.update_user(db, user.id, UserUpdate(username="user1"))
+        await db.close()
+
+        db = ShardedSession(sharded)
+        user = await UserCRUD.update_user(db, user.id, UserUpdate(username="renamed"))
+        assert user.username == "renamed"
+        assert await UserCRUD.delete_user_by_username(db, "user1") == 1
+        await UserCRUD.create_user(db, UserCreate(username="user0", password="password", email="email@gmail.com"))
+        await UserCRUD.create_user(db, UserCreate(username="user1", password="password", email="email@gmail.com"))
+        await db.close()
+
+    @pytest.mark.anyio
+    async def test_list_users_merges_shards(self, sharded):
+        await create_users(sharded, 20)
+        db = ShardedSession(sharded)
+        users = await UserCRUD.list_users(db, order="username", limit=5, after=("user15",))
+        assert [user.username for user in users] == ["user16", "user17", "user18", "user19", "user2"]
+        users = await UserCRUD.list_users(db, order="id", limit=50)
+        assert [user.id for user in users] == list(range(1, 21))
+        await db.close()
+
+    @pytest.mark.anyio
+    async def test_list_users_during_move(self, tmp_path):
+        database = await open_sharded_database(tmp_path, 2, buckets=2)
+        await create_users(database, 20)
+        # Bucket 0 has been copied to shard 1 but still belongs to shard 0
+        async with database.directory_sessionmaker() as directory_db:
+            results = await directory_db.execute(select(UserDirectory.id).filter(UserDirectory.bucket == 0))
+            user_ids = list(results.scalars().all())
+        await copy_users(database.engines[0], database.engines[1], user_ids)
+
+        db = ShardedSession(database)
+        listed = []
+        after = None
+        while True:
+            # As GET /users does: ask for one extra row to know whether another page exists
+            users = await UserCRUD.list_users(db, order="id", limit=4, after=after)
+            listed.extend(user.id for user in users[:3])
+            if len(users) <= 3:
+                break
+            after = (users[2].id,)
+        assert listed == list(range(1, 21))
+        await db.close()
+        await database.dispose()
+
+    @pytest.mark.anyio
+    async def test_tokens_follow_user(self, sharded):
+        await create_users(sharded, 5)
+        db = ShardedSession(sharded)
+        user = await UserCRUD.get_user_by_username(db, "user3")
+        user_id = user.id
+        await TokenCRUD.create_access_token(db, TokenCreate(token="access token", user_id=user_id))
+        await TokenCRUD.create_refresh_token(db, TokenCreate(token="refresh token", user_id=user_id))
+        assert (await TokenCRUD.get_access_token(db, "access token")).user_id == user_id
+        assert (await TokenCRUD.get_access_token(db, "access token", user_id=user_id)).user_id == user_id
+        token = await TokenCRUD.get_refresh_token_by_userid(db, user_id)
+        assert token.refresh_token_digest == token_digest("refresh token")
+        await db.close()
+
+class TestDirectoryBootstrap:
+    async def create_legacy_database(self, path, count: int) -> None:
+        # A single unsharded database with users, about to become shard 0
+        database = await open_sharded_database(path, 1)
+        await create_users(database, count)
+        await database.dispose()
+        (path / "directory.db").unlink()
+
+    @pytest.mark.anyio
+    async def test_existing_users_adopted(self, tmp_path):
+        await self.create_legacy_database(tmp_path, 10)
+        database = await open_sharded_database(tmp_path, 3)
+        assert database.bucket_shards() == [0] * database.buckets
+
+        db = ShardedSession(database)
+        user = await UserCRUD.get_user_by_username(db, "user7")
+        assert user.username == "user7"
+        user = await UserCRUD.create_user(db, UserCreate(username="new", password="password", email="email@gmail.com"))
+        assert user.id == 11
+        await db.close()
+
+        assert await rebalance(database, grace_seconds=0) > 0
+        counts = await shard_user_counts(database)
+        assert sum(counts) == 11
+        assert all(count > 0 for count in counts)
+        await database.dispose()
+
+    @pytest.mark.anyio
+    async def test_unknown_users_refused(self, tmp_path):
+        database = await open_sharded_database(tmp_path, 1)
+        await database.dispose()
+        # An existing database added after the directory was created
+        legacy_path = tmp_path / "legacy"
+        legacy_path.mkdir()
+        await self.create_legacy_database(legacy_path, 2)
+        (legacy_path / "shard0.db").rename(tmp_path / "shard1.db")
+        with pytest.raises(RuntimeError):
+            await open_sharded_database(tmp_path, 2)
+
+    @pytest.mark.anyio
+    async def test_several_populated_shards_refused(self, tmp_path):
+        for shard in range(2):
+            legacy_path = tmp_path / f"legacy{shard}"
+            legacy_path.mkdir()
+            await self.create_legacy_database(legacy_path, 2)
+            (legacy_path / "shard0.db").rename(tmp_path / f"shard{shard}.db")
+        with pytest.raises(RuntimeError):
+            await open_sharded_database(tmp_path, 2)
+
+class TestResharding:
+    def test_plan_rebalance(self):
+        moves = plan_rebalance([bucket % 2 for bucket in range(12)], 3)
+        assert len(moves) == 4
+        assert all(target == 2 for _, target in moves)
+
+    @pytest.mark.anyio
+    async def test_rebalance_onto_new_shard(self, tmp_path):
+        database = await open_sharded_database(tmp_path, 2)
+        await create_users(database, 30)
+        db = ShardedSession(database)
+        user = await UserCRUD.get_user_by_username(db, "user4")
+        await TokenCRUD.create_refresh_token(db, TokenCreate(token="refresh token", user_id=user.id))
+        await db.close()
+        await database.dispose()
+
+        database = await open_sharded_database(tmp_path, 3)
+        assert await rebalance(database, grace_seconds=0) > 0
+        counts = await shard_user_counts(database)
+        assert sum(counts) == 30
+        assert counts[2] > 0
+
+        db = ShardedSession(database)
+        for i in range(30):
+            user = await UserCRUD.get_user_by_username(db, f"user{i}")
+            assert user is not None
+            async with database.sessionmakers[database.shard_for_user_id(user.id)]() as shard_db:
+                assert await shard_db.get(User, user.id) is not None
+        user = await UserCRUD.get_user_by_username(db, "user4")
+        token = await TokenCRUD.get_refresh_token_by_userid(db, user.id)
+        assert token.refresh_token_digest == token_digest("refresh token")
+        await db.close()
+        await database.dispose()
+
+    @pytest.mark.anyio
+    async def test_writes_refused_while_moving(self, sharded):
+        await create_users(sharded, 1)
+        db = ShardedSession(sharded)
+        user = await UserCRUD.get_user_by_username(db, "user0")
+        user_id = user.id
+        bucket = shard_bucket(user_id, sharded.buckets)
+        await set_moving(sharded, True, bucket)
+        with pytest.raises(ShardMovingError):
+            await TokenCRUD.create_access_token(db, TokenCreate(token="access token", user_id=user_id))
+        assert (await UserCRUD.get_user_by_id(db, user_id)).username == "user0"
+        await db.close()
+
+        await set_moving(sharded, False, bucket)
+        target = (sharded.bucket_shards()[bucket] + 1) % 3
+        assert await move_bucket(sharded, bucket, target, grace_seconds=0) == 1
+        db = ShardedSession(sharded)
+        await TokenCRUD.create_access_token(db, TokenCreate(token="access token", user_id=user_id))
+        await db.close()
+
+class TestShardedEndpoints:
+    @pytest.fixture
+    async def sharded_app(self, sharded):
+        original_value = sharding.sharded_database
+        sharding.sharded_database = sharded
+        yield sharded
+        sharding.sharded_database = original_value
+
+    @pytest.mark.anyio
+    async def test_login_and_refresh(self, client, sharded_app):
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        response = await client.post("/users", json=user)
+        assert response.status_code == 201
+        response = await client.post("/users", json=user)
+        assert response.status_code == 409
+
+        response = await client.post("/token", data=user)
+        token = response.json()["access_token"]
+        headers = {'Authorization': f'Bearer {token}'}
+        response = await client.get("/users/me", headers=headers)
+        assert response.json()["username"] == "test"
+
+        response = await client.get("/refresh_token", headers=headers)
+        refresh_token = response.json()["refresh_token"]
+        response = await client.post("/refresh", json={"refresh_token": refresh_token}, headers=headers)
+        assert response.status_code == 200
+        assert sum(await shard_user_counts(sharded_app)) == 1
+
+    @pytest.mark.anyio
+    async def test_moving_bucket_returns_503(self, client, sharded_app):
+        await set_moving(sharded_app, True, *range(sharded_app.buckets))
+        user = {
+            "username": "test",
+            "password": "password",
+            "email": "email@gmail.com"
+        }
+        response = await client.post("/users", json=user)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(sharding.SHARD_RETRY_AFTER_SECONDS)
+        assert await sharded_app.user_id_for_username("test") is None
@@ -1,14 +1,20 @@
 from datetime import timedelta, datetime, timezone
 from unittest.mock import patch
+import asyncio
 
 import pytest
 from fastapi import HTTPException
 from sqlalchemy.exc import IntegrityError
 
-from env_setup import db_setup, db_session, anyio_backend
+from sqlalchemy import text
+
+from env_setup import db_setup, db_session, anyio_backend, SessionLocal, engine
+from database import upgrade_columns, upgrade_token_digests, upgrade_indexes
 from utils.password_utils import verify_password, get_password_hash
-from utils.jwt import create_access_token, create_refresh_token, decode_token, get_jwt_username
-from utils.crud import UserCRUD, TokenCRUD
+from utils.jwt import create_access_token, create_refresh_token, decode_token, get_jwt_username, token_digest, UserVersionRegistry
+from utils.crud import UserCRUD, TokenCRUD, lookup_flight, unit_of_work, prefix_upper_bound
+from utils.singleflight import SingleFlight
+from utils.profile_cache import ProfileCache, etag_matches, profile_etag
 import utils.crud
 from schemas.user_schemas import UserCreate, UserUpdate
 from schemas.token_schemas import TokenCreate
@@ -61,6 +67,172 @@ class TestJWT:
             get_jwt_username("invalid_token")
         assert http_401.value.status_code == 401
 
+    def test_create_access_token_user_claims(self):
+        access_token = create_access_token("test", user_id=1, email="email@gmail.com", version=2)
+        payload = decode_token(access_token)
+        assert payload["sub"] == "test"
+        assert payload["uid"] == 1
+        assert payload["email"] == "email@gmail.com"
+        assert payload["ver"] == 2
+
+    def test_user_version_registry(self):
+        registry = UserVersionRegistry()
+        assert registry.is_current(1, 1) == True
+        registry.record(1, 2)
+        assert registry.is_current(1, 1) == False
+        assert registry.is_current(1, 2) == True
+        registry.revoke(1)
+        assert registry.is_current(1, 2) == False
+
+    def test_user_version_registry_eviction(self):
+        registry = UserVersionRegistry(ttl_seconds=60)
+        with patch("utils.jwt.time") as mock_time:
+            mock_time.monotonic.return_value = 0
+            registry.record(1, 2)
+            mock_time.monotonic.return_value = 30
+            registry.record(2, 2)
+            assert len(registry) == 2
+            mock_time.monotonic.return_value = 61
+            assert registry.is_current(1, 1) == True
+            assert registry.is_current(2, 1) == False
+            assert len(registry) == 1
+
+class TestPrefixUpperBound:
+    def test_prefix_upper_bound(self):
+        assert prefix_upper_bound("al") == "am"
+        assert prefix_upper_bound("a" + chr(0x10FFFF)) == "b"
+        assert prefix_upper_bound("a" + chr(0xD7FF)) == "a" + chr(0xE000)
+        assert prefix_upper_bound(chr(0x10FFFF)) is None
+
+class TestSingleFlight:
+    @pytest.mark.anyio
+    async def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        call_count = 0
+        async def query():
+            nonlocal call_count
+            call_count += 1
+            await asyncio.sleep(0.01)
+            return "result"
+        results = await asyncio.gather(*[flight.do("key", query) for _ in range(5)])
+        assert results == ["result"] * 5
+        assert call_count == 1
+        assert flight.metrics() == {"calls": 5, "coalesced": 4, "in_flight": 0}
+
+    @pytest.mark.anyio
+    async def test_error_propagates_to_followers(self):
+        flight = SingleFlight()
+        async def query():
+            await asyncio.sleep(0.01)
+            raise ValueError("query failed")
+        results = await asyncio.gather(*[flight.do("key", query) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flight.metrics()["in_flight"] == 0
+
+    @pytest.mark.anyio
+    async def test_leader_cancellation_retries_followers(self):
+        flight = SingleFlight()
+        call_count = 0
+        async def query():
+            nonlocal call_count
+            call_count += 1
+            await asyncio.sleep(0.01)
+            return call_count
+        leader = asyncio.create_task(flight.do("key", query))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", query))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == 2
+        assert leader.cancelled()
+        assert flight.metrics()["coalesced"] == 0
+
+    @pytest.mark.anyio
+    async def test_forget_starts_new_call(self):
+        flight = SingleFlight()
+        call_count = 0
+        async def query():
+            nonlocal call_count
+            call_count += 1
+            call_number = call_count
+            await asyncio.sleep(0.01)
+            return call_number
+        first = asyncio.create_task(flight.do("key", query))
+        await asyncio.sleep(0)
+        flight.forget("key")
+        second = asyncio.create_task(flight.do("key", query))
+        assert await first == 1
+        assert await second == 2
+        assert flight.metrics()["in_flight"] == 0
+
+    @pytest.mark.anyio
+    async def test_follower_cancellation_does_not_cancel_leader(self):
+        flight = SingleFlight()
+        async def query():
+            await asyncio.sleep(0.01)
+            return "result"
+        leader = asyncio.create_task(flight.do("key", query))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", query))
+        await asyncio.sleep(0)
+        follower.cancel()
+        assert await leader == "result"
+
+class TestProfileCache:
+    def test_etag_matches(self):
+        etag = profile_etag(1, 2)
+        assert etag_matches(etag, etag)
+        assert etag_matches('"1-2"', etag)
+        assert etag_matches('W/"1-1", W/"1-2"', etag)
+        assert etag_matches("*", etag)
+        assert not etag_matches('W/"1-1"', etag)
+        assert not etag_matches(None, etag)
+
+    def test_get_put(self):
+        cache = ProfileCache(max_size=2)
+        cache.put(1, 1, b"one")
+        assert cache.get(1, 1) == b"one"
+        assert cache.get(1, 2) is None
+        cache.put(2, 1, b"two")
+        cache.get(1, 1)
+        cache.put(3, 1, b"three")
+        assert len(cache) == 2
+        assert cache.get(2, 1) is None
+        cache.invalidate(1)
+        assert cache.get(1, 1) is None
+
+class TestDatabase:
+    @pytest.mark.anyio
+    async def test_upgrade_columns(self, db_setup):
+        async with engine.begin() as conn:
+            await conn.execute(text("DROP TABLE users"))
+            await conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL, email VARCHAR, password_hash VARCHAR NOT NULL, create_time DATETIME NOT NULL, last_update_time DATETIME)"))
+            await conn.execute(text("INSERT INTO users (username, email, password_hash, create_time) VALUES ('test', '', 'hash', '2024-01-01')"))
+            await conn.run_sync(upgrade_columns)
+            await conn.run_sync(upgrade_columns)
+            result = await conn.execute(text("SELECT version FROM users"))
+            assert result.scalar() == 1
+
+    @pytest.mark.anyio
+    async def test_upgrade_token_digests(self, db_setup):
+        async with engine.begin() as conn:
+            await conn.execute(text("INSERT INTO users (username, email, password_hash, create_time, version, is_admin) VALUES ('test', '', 'hash', '2024-01-01', 1, 0)"))
+            await conn.execute(text("DROP TABLE access_tokens"))
+            await conn.execute(text("DROP TABLE refresh_tokens"))
+            await conn.execute(text("CREATE TABLE access_tokens (id INTEGER PRIMARY KEY, access_token VARCHAR NOT NULL, expiration_time DATETIME NOT NULL, user_id INTEGER REFERENCES users(id) ON DELETE CASCADE, create_time DATETIME NOT NULL)"))
+            await conn.execute(text("CREATE INDEX ix_access_tokens_access_token ON access_tokens (access_token)"))
+            await conn.execute(text("CREATE TABLE refresh_tokens (user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE, refresh_token VARCHAR NOT NULL, expiration_time DATETIME NOT NULL, create_time DATETIME NOT NULL)"))
+            await conn.execute(text("INSERT INTO access_tokens (id, access_token, expiration_time, user_id, create_time) VALUES (7, 'access token', '2024-01-02', 1, '2024-01-01')"))
+            await conn.execute(text("INSERT INTO refresh_tokens (user_id, refresh_token, expiration_time, create_time) VALUES (1, 'refresh token', '2024-01-02', '2024-01-01')"))
+            await conn.run_sync(upgrade_token_digests)
+            await conn.run_sync(upgrade_token_digests)
+            await conn.run_sync(upgrade_indexes)
+        async with SessionLocal() as db:
+            token = await TokenCRUD.get_access_token(db, "access token")
+            assert token.id == 7
+            token = await TokenCRUD.get_refresh_token_by_userid(db, 1)
+            assert token.refresh_token_digest == token_digest("refresh token")
+
 class TestCRUD:    
     @pytest.mark.anyio
     async def test_create_user(self, db_setup, db_session):
@@ -88,6 +260,43 @@ class TestCRUD:
         assert verify_password("password", user.password_hash) == True
         assert user.email == "email@gmail.com"
     
+    @pytest.mark.anyio
+    async def test_get_user_by_username_coalesced(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        await UserCRUD.create_user(db_session, user)
+        sessions = [SessionLocal() for _ in range(3)]
+        coalesced_before = lookup_flight.coalesced
+        try:
+            users = await asyncio.gather(*[UserCRUD.get_user_by_username(db, "test") for db in sessions])
+            assert lookup_flight.coalesced - coalesced_before == 2
+            for db, user in zip(sessions, users):
+                assert user.username == "test"
+                assert user in db
+            await UserCRUD.update_user(sessions[1], users[1].id, UserUpdate(email="email2@gmail.com"))
+            user = await UserCRUD.get_user_by_id(db_session, users[1].id)
+            await db_session.refresh(user)
+            assert user.email == "email2@gmail.com"
+        finally:
+            for db in sessions:
+                await db.close()
+
+    @pytest.mark.anyio
+    async def test_lookup_not_coalesced_with_loaded_instances(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        db_user = await UserCRUD.create_user(db_session, user)
+        other_session = SessionLocal()
+        coalesced_before = lookup_flight.coalesced
+        try:
+            users = await asyncio.gather(
+                UserCRUD.get_user_by_username(other_session, "test"),
+                UserCRUD.get_user_by_username(db_session, "test")
+            )
+            assert lookup_flight.coalesced == coalesced_before
+            assert users[0] in other_session
+            assert users[1] is db_user
+        finally:
+            await other_session.close()
+
     @pytest.mark.anyio
     async def test_delete_user_by_username(self, db_setup, db_session):
         user = UserCreate(username="test", password="password", email="email@gmail.com")
@@ -102,9 +311,23 @@ class TestCRUD:
         user = await UserCRUD.create_user(db_session, user)
         user = await UserCRUD.update_user(db_session, user.id, update_info)
         assert user.username == "test2"
+        assert user.version == 2
         assert verify_password("password2", user.password_hash) == True
         assert user.email == "email2@gmail.com"
 
+    @pytest.mark.anyio
+    async def test_update_user_increments_current_version(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        user = await UserCRUD.create_user(db_session, user)
+        user_id = user.id
+        # Another request updates the row after this session loaded it
+        async with SessionLocal() as other_session:
+            await UserCRUD.update_user(other_session, user_id, UserUpdate(email="other@gmail.com"))
+        assert user.version == 1
+        user = await UserCRUD.update_user(db_session, user_id, UserUpdate(username="test2"))
+        assert user.version == 3
+        assert user.email == "other@gmail.com"
+
     @pytest.mark.anyio
     async def test_create_access_token(self, db_setup, db_session):
         user = UserCreate(username="test", password="password", email="email@gmail.com")
@@ -113,7 +336,48 @@ class TestCRUD:
         token = TokenCreate(token="access token", user_id=user_id)
         token = await TokenCRUD.create_access_token(db_session, token)
         assert token.access_token == "access token"
+        assert token.access_token_digest == token_digest("access token")
+        assert token.user_id == user_id
+
+    @pytest.mark.anyio
+    async def test_lookup_releases_connection(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        user = await UserCRUD.create_user(db_session, user)
+        assert not db_session.in_transaction()
+        user = await UserCRUD.get_user_by_id(db_session, user.id)
+        assert not db_session.in_transaction()
+        assert user.username == "test"
+
+    @pytest.mark.anyio
+    async def test_unit_of_work(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        user = await UserCRUD.create_user(db_session, user)
+        user_id = user.id
+        with pytest.raises(RuntimeError):
+            async with unit_of_work(db_session):
+                await TokenCRUD.create_access_token(db_session, TokenCreate(token="rolled back", user_id=user_id))
+                assert db_session.in_transaction()
+                raise RuntimeError()
+        assert await TokenCRUD.get_access_token(db_session, "rolled back") is None
+
+        async with unit_of_work(db_session):
+            await TokenCRUD.create_access_token(db_session, TokenCreate(token="access token", user_id=user_id))
+            await TokenCRUD.create_refresh_token(db_session, TokenCreate(token="refresh token", user_id=user_id))
+        assert not db_session.in_transaction()
+        async with SessionLocal() as db:
+            assert (await TokenCRUD.get_access_token(db, "access token")).user_id == user_id
+            assert await TokenCRUD.get_refresh_token_by_userid(db, user_id) is not None
+
+    @pytest.mark.anyio
+    async def test_get_access_token(self, db_setup, db_session):
+        user = UserCreate(username="test", password="password", email="email@gmail.com")
+        user = await UserCRUD.create_user(db_session, user)
+        user_id = user.id
+        token = TokenCreate(token="access token", user_id=user_id)
+        await TokenCRUD.create_access_token(db_session, token)
+        token = await TokenCRUD.get_access_token(db_session, "access token")
         assert token.user_id == user_id
+        assert await TokenCRUD.get_access_token(db_session, "other token") is None
     
     @pytest.mark.anyio
     async def test_create_refresh_token(self, db_setup, db_session):
@@ -144,7 +408,7 @@ class TestCRUD:
         token = TokenCreate(token="refresh token", user_id=user_id)
         await TokenCRUD.create_refresh_token(db_session, token)
         token = await TokenCRUD.get_refresh_token_by_userid(db_session, user_id)
-        assert token.refresh_token == "refresh token"
+        assert token.refresh_token_digest == token_digest("refresh token")
         assert token.user_id == user_id
     
     @pytest.mark.anyio
@@ -0,0 +1,175 @@
+import asyncio
+import os
+from collections import deque
+from enum import Enum
+
+from fastapi.responses import JSONResponse
+
+ADMISSION_LOGIN_CONCURRENCY = int(os.environ.get("ADMISSION_LOGIN_CONCURRENCY", 4))
+ADMISSION_SIGNUP_CONCURRENCY = int(os.environ.get("ADMISSION_SIGNUP_CONCURRENCY", 2))
+ADMISSION_UPDATE_CONCURRENCY = int(os.environ.get("ADMISSION_UPDATE_CONCURRENCY", 2))
+ADMISSION_NORMAL_CONCURRENCY = int(os.environ.get("ADMISSION_NORMAL_CONCURRENCY", 64))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 32))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 2))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", 1))
+
+
+class Priority(str, Enum):
+    CRITICAL = "critical"
+    NORMAL = "normal"
+    EXPENSIVE = "expensive"
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        # Each waiter resolves exactly once: True when release() hands it a slot, False at its deadline
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            return False
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        deadline = loop.call_later(self.queue_timeout, self._expire, waiter)
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                # The slot was handed over before the cancellation landed; pass it on
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            deadline.cancel()
+        if not granted:
+            self.rejected_timeout += 1
+        return granted
+
+    def _expire(self, waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            self._waiters.remove(waiter)
+            waiter.set_result(False)
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next waiter; active stays the same
+                self.admitted += 1
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+
+class AdmissionController:
+    def __init__(
+        self, 
+        priorities: dict[tuple[str, str], Priority], 
+        limiters: dict[tuple[str, str], ConcurrencyLimiter],
+        normal_limiter: ConcurrencyLimiter | None = None,
+        critical_prefixes: tuple[str, ...] = ()
+    ):
+        self.priorities = priorities
+        self.limiters = limiters
+        self.normal_limiter = normal_limiter
+        # Every method and subpath under these is critical
+        self.critical_prefixes = critical_prefixes
+
+    def get_priority(self, method: str, path: str) -> Priority:
+        for prefix in self.critical_prefixes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return Priority.CRITICAL
+        return self.priorities.get((method, path), Priority.NORMAL)
+
+    def get_limiter(self, method: str, path: str) -> ConcurrencyLimiter | None:
+        priority = self.get_priority(method, path)
+        if priority is Priority.CRITICAL:
+            return None
+        if priority is Priority.EXPENSIVE:
+            return self.limiters.get((method, path))
+        return self.normal_limiter
+
+    def metrics(self) -> dict:
+        metrics = {
+            f"{method} {path}": limiter.metrics()
+            for (method, path), limiter in self.limiters.items()
+        }
+        if self.normal_limiter is not None:
+            metrics["normal"] = self.normal_limiter.metrics()
+        return metrics
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, app, controller: AdmissionController, retry_after: int = ADMISSION_RETRY_AFTER_SECONDS):
+        self.app = app
+        self.controller = controller
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limiter = self.controller.get_limiter(scope["method"], scope["path"])
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+        if not await limiter.acquire():
+            response = JSONResponse(
+                {"detail": "Server Busy"},
+                status_code=503,
+                headers={"Retry-After": str(self.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+admission_controller = AdmissionController(
+    priorities={
+        ("GET", "/livenessProbe"): Priority.CRITICAL,
+        ("GET", "/users/me"): Priority.CRITICAL,
+        ("POST", "/token"): Priority.EXPENSIVE,
+        ("POST", "/users"): Priority.EXPENSIVE,
+        # May hash a new password in the threadpool, like signup
+        ("PUT", "/users"): Priority.EXPENSIVE,
+    },
+    limiters={
+        ("POST", "/token"): ConcurrencyLimiter(ADMISSION_LOGIN_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+        ("POST", "/users"): ConcurrencyLimiter(ADMISSION_SIGNUP_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+        ("PUT", "/users"): ConcurrencyLimiter(ADMISSION_UPDATE_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+    },
+    normal_limiter=ConcurrencyLimiter(ADMISSION_NORMAL_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS),
+    # Forward auth, called with the original request's method and path
+    critical_prefixes=("/verify",)
+)
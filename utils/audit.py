@@ -0,0 +1,324 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from enum import Enum
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert, select
+
+from database import SessionLocal
+from models.login_event import LoginEvent
+
+AUDIT_SINK = os.environ.get("AUDIT_SINK", "file")
+AUDIT_DIR = os.environ.get("AUDIT_DIR", "audit")
+AUDIT_FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", 1))
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", 1000))
+AUDIT_MAX_BUFFER = int(os.environ.get("AUDIT_MAX_BUFFER", 100000))
+AUDIT_SEGMENT_MAX_BYTES = int(os.environ.get("AUDIT_SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+AUDIT_MAX_SEGMENTS = int(os.environ.get("AUDIT_MAX_SEGMENTS", 16))
+AUDIT_INDEX_EVENTS_PER_USER = int(os.environ.get("AUDIT_INDEX_EVENTS_PER_USER", 100))
+
+logger = logging.getLogger(__name__)
+
+
+class AuditEventType(str, Enum):
+    LOGIN_SUCCESS = "login_success"
+    LOGIN_FAILURE = "login_failure"
+    REFRESH_TOKEN_ISSUED = "refresh_token_issued"
+    REFRESH_SUCCESS = "refresh_success"
+    REFRESH_FAILURE = "refresh_failure"
+
+
+def event_time(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+class SegmentFileSink:
+    SEGMENT_PREFIX = "audit-"
+    SEGMENT_SUFFIX = ".log"
+
+    def __init__(
+        self,
+        directory: str,
+        segment_max_bytes: int = AUDIT_SEGMENT_MAX_BYTES,
+        max_segments: int = AUDIT_MAX_SEGMENTS,
+        index_events_per_user: int = AUDIT_INDEX_EVENTS_PER_USER
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+        self.index_events_per_user = index_events_per_user
+        # user_id -> (segment, offset, length) of that user's most recent events
+        self._index: dict[int, deque[tuple[int, int, int]]] = {}
+        self._segment = 1
+        self._segment_size = 0
+        self._first_segment = 1
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment:08d}{self.SEGMENT_SUFFIX}")
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)
+        )
+
+    def _index_event(self, user_id: int | None, location: tuple[int, int, int]) -> None:
+        if user_id is None:
+            return
+        entries = self._index.get(user_id)
+        if entries is None:
+            entries = self._index[user_id] = deque(maxlen=self.index_events_per_user)
+        entries.append(location)
+
+    def open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._index.clear()
+        segments = self._segments()
+        for segment in segments:
+            for user_id, location in self._scan_segment(segment):
+                self._index_event(user_id, location)
+        if segments:
+            self._first_segment = segments[0]
+            self._segment = segments[-1]
+            self._segment_size = os.path.getsize(self._segment_path(self._segment))
+            if not self._ends_with_newline(self._segment):
+                # A torn write from a crash; never append after a partial record
+                self._segment += 1
+                self._segment_size = 0
+
+    def _ends_with_newline(self, segment: int) -> bool:
+        if self._segment_size == 0:
+            return True
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _scan_segment(self, segment: int):
+        path = self._segment_path(segment)
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset < len(data):
+                end = data.find(b"\n", offset)
+                if end == -1:
+                    break
+                try:
+                    event = json.loads(data[offset:end])
+                except ValueError:
+                    event = {}
+                yield event.get("user_id"), (segment, offset, end - offset)
+                offset = end + 1
+
+    def _write_batch(self, events: list[dict]) -> list[tuple[int | None, tuple[int, int, int]]]:
+        locations = []
+        f = open(self._segment_path(self._segment), "ab")
+        try:
+            for event in events:
+                line = json.dumps(event, separators=(",", ":")).encode() + b"\n"
+                if self._segment_size > 0 and self._segment_size + len(line) > self.segment_max_bytes:
+                    os.fsync(f.fileno())
+                    f.close()
+                    self._segment += 1
+                    self._segment_size = 0
+                    f = open(self._segment_path(self._segment), "ab")
+                f.write(line)
+                locations.append((event.get("user_id"), (self._segment, self._segment_size, len(line) - 1)))
+                self._segment_size += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self._enforce_retention()
+        return locations
+
+    def _enforce_retention(self) -> None:
+        segments = self._segments()
+        for segment in segments[:max(len(segments) - self.max_segments, 0)]:
+            os.remove(self._segment_path(segment))
+        self._first_segment = max(self._first_segment, self._segment - self.max_segments + 1)
+
+    def _read_events(self, locations: list[tuple[int, int, int]]) -> list[dict]:
+        events = []
+        by_segment: dict[int, list[tuple[int, int]]] = {}
+        for segment, offset, length in locations:
+            if segment >= self._first_segment:
+                by_segment.setdefault(segment, []).append((offset, length))
+        for segment, ranges in by_segment.items():
+            try:
+                with open(self._segment_path(segment), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    events.extend(json.loads(data[offset:offset + length]) for offset, length in ranges)
+            except FileNotFoundError:
+                continue
+        return events
+
+    async def write(self, events: list[dict]) -> None:
+        locations = await run_in_threadpool(self._write_batch, events)
+        for user_id, location in locations:
+            self._index_event(user_id, location)
+
+    async def recent_events(self, user_id: int, limit: int) -> list[dict]:
+        locations = list(self._index.get(user_id, ()))[-limit:]
+        if not locations:
+            return []
+        events = await run_in_threadpool(self._read_events, locations)
+        events.sort(key=lambda event: event["time"], reverse=True)
+        return events
+
+
+class DatabaseSink:
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+
+    def open(self) -> None:
+        pass
+
+    async def write(self, events: list[dict]) -> None:
+        rows = [
+            {
+                "event": event["event"],
+                "user_id": event["user_id"],
+                "username": event["username"],
+                "source_ip": event["source_ip"],
+                "create_time": event_time(event["time"]).replace(tzinfo=None)
+            }
+            for event in events
+        ]
+        async with self.session_factory() as db:
+            await db.execute(insert(LoginEvent), rows)
+            await db.commit()
+
+    async def recent_events(self, user_id: int, limit: int) -> list[dict]:
+        async with self.session_factory() as db:
+            results = await db.execute(
+                select(LoginEvent)
+                .filter(LoginEvent.user_id == user_id)
+                .order_by(LoginEvent.create_time.desc())
+                .limit(limit)
+            )
+            return [
+                {
+                    "event": row.event,
+                    "user_id": row.user_id,
+                    "username": row.username,
+                    "source_ip": row.source_ip,
+                    "time": row.create_time.replace(tzinfo=timezone.utc).timestamp()
+                }
+                for row in results.scalars()
+            ]
+
+
+class AuditLog:
+    def __init__(
+        self,
+        sink,
+        flush_interval: float = AUDIT_FLUSH_SECONDS,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        max_buffer: int = AUDIT_MAX_BUFFER
+    ):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self._buffer: list[dict] = []
+        self._flushing: list[dict] = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def record(
+        self,
+        event: AuditEventType,
+        username: str,
+        user_id: int | None = None,
+        source_ip: str | None = None
+    ) -> None:
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.recorded += 1
+        self._buffer.append({
+            "event": event.value,
+            "user_id": user_id,
+            "username": username,
+            "source_ip": source_ip,
+            "time": time.time()
+        })
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            self._flushing, self._buffer = self._buffer, []
+            try:
+                await self.sink.write(self._flushing)
+                self.flushed += len(self._flushing)
+            except Exception:
+                # Keep the batch for the next flush, dropping the oldest events beyond the buffer limit
+                self._buffer[:0] = self._flushing
+                overflow = len(self._buffer) - self.max_buffer
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+                raise
+            finally:
+                self._flushing = []
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush audit events")
+
+    async def start(self) -> None:
+        await run_in_threadpool(self.sink.open)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Let an in-progress write finish instead of cancelling it mid-batch
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "buffered": len(self._buffer) + len(self._flushing),
+        }
+
+    async def recent_events(self, user_id: int, limit: int = 20) -> list[dict]:
+        unflushed = [
+            event for event in reversed(self._flushing + self._buffer)
+            if event["user_id"] == user_id
+        ][:limit]
+        if len(unflushed) == limit:
+            return unflushed
+        return unflushed + await self.sink.recent_events(user_id, limit - len(unflushed))
+
+
+audit_log = AuditLog(DatabaseSink() if AUDIT_SINK == "database" else SegmentFileSink(AUDIT_DIR))
@@ -1,105 +1,380 @@
+import asyncio
+import heapq
+import sys
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
+from sqlalchemy import String, select, delete, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.functions import FunctionElement
+from fastapi.concurrency import run_in_threadpool
 
 from models.user import User
 from models.access_token import AccessToken
 from models.refresh_token import RefreshToken
 from schemas.user_schemas import UserCreate, UserUpdate
 from schemas.token_schemas import TokenCreate
+from sharding import ShardedSession
 from utils.password_utils import get_password_hash
-from utils.jwt import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
+from utils.jwt import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, user_versions, token_digest
+from utils.singleflight import SingleFlight
+from utils.profile_cache import profile_cache
+
+lookup_flight = SingleFlight()
+
+def lookup_key(model, column: str, value) -> tuple:
+    return (model.__tablename__, column, value)
+
+def forget_lookups(*keys: tuple) -> None:
+    # Callers arriving after a write must not join a query that started before it
+    for key in keys:
+        lookup_flight.forget(key)
+
+async def first(db: AsyncSession, statement):
+    results = await db.execute(statement)
+    return results.scalars().first()
+
+async def coalesced_first(db: AsyncSession, model, key: tuple, statement):
+    # Only sessions that hold no instances of the model coalesce, so a shared snapshot
+    # never overwrites rows this session already loaded, modified or committed.
+    if any(isinstance(instance, model) for instance in db.identity_map.values()) or db.new or db.dirty:
+        return await first(db, statement)
+
+    # Concurrent callers share one query; each gets the row as an instance of its own session
+    async def query() -> dict | None:
+        row = await first(db, statement)
+        if row is None:
+            return None
+        return {attr.key: getattr(row, attr.key) for attr in model.__mapper__.column_attrs}
+
+    values = await lookup_flight.do(key, query)
+    if values is None:
+        return None
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return await db.merge(instance, load=False)
+
+async def user_session(
+    db: AsyncSession | ShardedSession, 
+    user_id: int | None = None, 
+    username: str | None = None, 
+    write: bool = False
+) -> AsyncSession | None:
+    # A plain session holds every user; a sharded one routes to the shard owning the user
+    if not isinstance(db, ShardedSession):
+        return db
+    if user_id is None:
+        return await db.for_username(username, write)
+    return await db.for_user_id(user_id, write)
+
+def shard_sessions(db: AsyncSession | ShardedSession) -> list[tuple[int | None, AsyncSession]]:
+    if not isinstance(db, ShardedSession):
+        return [(None, db)]
+    return db.all_sessions()
+
+UNIT_OF_WORK = "unit_of_work"
+
+def open_sessions(db: AsyncSession | ShardedSession) -> list[AsyncSession]:
+    return db.open_sessions() if isinstance(db, ShardedSession) else [db]
+
+async def commit(db: AsyncSession) -> None:
+    # Inside unit_of_work the enclosing block commits once at the end
+    if db.info.get(UNIT_OF_WORK):
+        await db.flush()
+    else:
+        await db.commit()
+
+async def save(db: AsyncSession, instance) -> None:
+    # Reload server-side values before committing, so no new transaction is opened afterwards
+    await db.flush()
+    await db.refresh(instance)
+    await commit(db)
+
+async def release(db: AsyncSession | ShardedSession) -> None:
+    # End a read-only transaction so its connection goes back to the pool right away
+    # instead of staying checked out until the request's session is closed
+    for session in open_sessions(db):
+        if not session.info.get(UNIT_OF_WORK) and session.in_transaction() and not (session.new or session.dirty or session.deleted):
+            await session.commit()
+
+@asynccontextmanager
+async def unit_of_work(db: AsyncSession | ShardedSession):
+    # Runs the enclosed CRUD calls as one transaction: they flush instead of committing, the
+    # connection is checked out by the first statement and returned by the single commit
+    db.info[UNIT_OF_WORK] = True
+    for session in open_sessions(db):
+        session.info[UNIT_OF_WORK] = True
+    try:
+        yield db
+        for session in open_sessions(db):
+            await session.commit()
+    except BaseException:
+        for session in open_sessions(db):
+            await session.rollback()
+        raise
+    finally:
+        db.info.pop(UNIT_OF_WORK, None)
+        for session in open_sessions(db):
+            session.info.pop(UNIT_OF_WORK, None)
+
+class bytewise(FunctionElement):
+    # Compares text in code point order, like Python str, so ordering and prefix ranges can use
+    # ix_users_username_bytewise and shard pages merge in the same order
+    type = String()
+    inherit_cache = True
+
+@compiles(bytewise)
+def compile_bytewise(element, compiler, **kw):
+    # SQLite's default BINARY collation already compares bytewise
+    return compiler.process(element.clauses, **kw)
+
+@compiles(bytewise, "postgresql")
+def compile_bytewise_postgresql(element, compiler, **kw):
+    return f'{compiler.process(element.clauses, **kw)} COLLATE "C"'
+
+def prefix_upper_bound(prefix: str) -> str | None:
+    # The smallest string after every string that starts with prefix
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return None
+    code_point = ord(stripped[-1]) + 1
+    if 0xD800 <= code_point <= 0xDFFF:
+        # Surrogates are not valid text
+        code_point = 0xE000
+    return stripped[:-1] + chr(code_point)
+
+USER_LIST_ORDERS = {
+    "id": (User.id,),
+    "create_time": (User.create_time, User.id),
+    "username": (User.username,),
+}
+
+def sort_expression(column):
+    return bytewise(column) if column is User.username else column
 
 class UserCRUD:
     @staticmethod
-    async def get_user_by_username(db: AsyncSession, username: str) -> User | None:
-        results = await db.execute(select(User).filter(User.username == username))
-        return results.scalars().first()
+    async def get_user_by_username(db: AsyncSession | ShardedSession, username: str) -> User | None:
+        db = await user_session(db, username=username)
+        if db is None:
+            return None
+        user = await coalesced_first(db, User, lookup_key(User, "username", username), select(User).filter(User.username == username))
+        await release(db)
+        return user
 
     @staticmethod
-    async def get_user_by_id(db: AsyncSession, user_id: int) -> User | None:
-        results = await db.execute(select(User).filter(User.id == user_id))
-        return results.scalars().first()
+    async def get_user_by_id(db: AsyncSession | ShardedSession, user_id: int) -> User | None:
+        db = await user_session(db, user_id=user_id)
+        user = await coalesced_first(db, User, lookup_key(User, "id", user_id), select(User).filter(User.id == user_id))
+        await release(db)
+        return user
+
+    @staticmethod
+    async def list_users(
+        db: AsyncSession | ShardedSession, 
+        order: str = "id", 
+        limit: int = 50, 
+        after: tuple | None = None, 
+        prefix: str | None = None
+    ) -> list[User]:
+        # Keyset pagination: seek past the last key instead of OFFSET so every page costs the same.
+        # A prefix is searched as a bytewise username range, so it needs order="username" to stay
+        # on the index.
+        columns = USER_LIST_ORDERS[order]
+        if prefix and order != "username":
+            raise ValueError("Prefix search is only supported with order='username'")
+        sort_columns = [sort_expression(column) for column in columns]
+        key = lambda user: tuple(getattr(user, column.key) for column in columns)
+
+        def page_statement(after: tuple | None):
+            statement = select(User)
+            if prefix:
+                # One lower bound only: the cursor's when there is one, so the index seek starts there
+                if after is None or after[0] < prefix:
+                    statement = statement.filter(bytewise(User.username) >= prefix)
+                upper_bound = prefix_upper_bound(prefix)
+                if upper_bound is not None:
+                    statement = statement.filter(bytewise(User.username) < upper_bound)
+            if after is not None:
+                if len(columns) == 1:
+                    statement = statement.filter(sort_columns[0] > after[0])
+                else:
+                    statement = statement.filter(tuple_(*sort_columns) > tuple_(*after))
+            return statement.order_by(*sort_columns).limit(limit)
+
+        async def shard_page(shard: int | None, session: AsyncSession) -> list[User]:
+            users = []
+            page_after = after
+            while True:
+                results = await session.execute(page_statement(page_after))
+                rows = results.scalars().all()
+                if shard is None:
+                    return list(rows)
+                # Skip copies left on another shard while a bucket is being moved, and read on
+                # until the shard has a full page of its own users or runs out
+                users.extend(user for user in rows if db.database.shard_for_user_id(user.id) == shard)
+                if len(users) >= limit or len(rows) < limit:
+                    return users[:limit]
+                page_after = key(rows[-1])
+
+        pages = await asyncio.gather(*[shard_page(shard, session) for shard, session in shard_sessions(db)])
+        await release(db)
+        if len(pages) == 1:
+            return pages[0]
+        return list(heapq.merge(*pages, key=key))[:limit]
 
     @staticmethod
-    async def create_user(db: AsyncSession, user: UserCreate) -> User:
-        hashed_password = get_password_hash(user.password)
+    async def create_user(db: AsyncSession | ShardedSession, user: UserCreate) -> User:
+        hashed_password = await run_in_threadpool(get_password_hash, user.password)
         db_user = User(username=user.username, password_hash=hashed_password, email=user.email)
-        db.add(db_user)
-        await db.commit()
-        await db.refresh(db_user)
+        if isinstance(db, ShardedSession):
+            # The directory allocates the id and rejects usernames taken on any shard
+            directory = db.database
+            db_user.id = await directory.allocate_user_id(user.username)
+            try:
+                db = await db.for_user_id(db_user.id, write=True)
+                db.add(db_user)
+                await save(db, db_user)
+            except Exception:
+                await directory.release_user_id(db_user.id)
+                raise
+        else:
+            db.add(db_user)
+            await save(db, db_user)
+        forget_lookups(lookup_key(User, "username", user.username))
         return db_user
 
     @staticmethod
-    async def delete_user_by_username(db: AsyncSession, username: str) -> int:
-        result = await db.execute(delete(User).where(User.username == username))
-        await db.commit()
-        return result.rowcount
+    async def delete_user_by_username(db: AsyncSession | ShardedSession, username: str) -> int:
+        session = await user_session(db, username=username, write=True)
+        if session is None:
+            return 0
+        result = await session.execute(delete(User).where(User.username == username).returning(User.id))
+        user_ids = result.scalars().all()
+        await commit(session)
+        if isinstance(db, ShardedSession):
+            for user_id in user_ids:
+                await db.database.release_user_id(user_id)
+        forget_lookups(lookup_key(User, "username", username))
+        for user_id in user_ids:
+            forget_lookups(lookup_key(User, "id", user_id), lookup_key(RefreshToken, "user_id", user_id))
+            user_versions.revoke(user_id)
+            profile_cache.invalidate(user_id)
+        return len(user_ids)
 
     @staticmethod
-    async def update_user(db: AsyncSession, user_id: int, user: UserUpdate) -> User | None:
-        db_user = await UserCRUD.get_user_by_id(db, user_id)
+    async def update_user(db: AsyncSession | ShardedSession, user_id: int, user: UserUpdate) -> User | None:
+        # Hash before reading, so the transaction is not held open through bcrypt
+        password_hash = await run_in_threadpool(get_password_hash, user.password) if user.password is not None else None
+        session = await user_session(db, user_id=user_id, write=True)
+        # The session may already hold this user from the request's auth lookup; read the current row
+        db_user = await first(session, select(User).filter(User.id == user_id).execution_options(populate_existing=True))
         if db_user is not None:
+            previous_username = db_user.username
+            renamed = isinstance(db, ShardedSession) and user.username is not None and user.username != previous_username
+            if renamed:
+                # Claim the new name in the directory first; raises IntegrityError when taken
+                await db.database.rename_user(user_id, user.username)
             if user.username is not None:
                 db_user.username = user.username
-            if user.password is not None:
-                db_user.password_hash = get_password_hash(user.password)
+            if password_hash is not None:
+                db_user.password_hash = password_hash
             if user.email is not None:
                 db_user.email = user.email
-            await db.commit()
-            await db.refresh(db_user)
+            # Incremented in SQL so concurrent updates never write the same version; save() reloads it
+            db_user.version = User.version + 1
+            try:
+                await save(session, db_user)
+            except Exception:
+                if renamed:
+                    await db.database.rename_user(user_id, previous_username)
+                raise
+            forget_lookups(
+                lookup_key(User, "id", user_id),
+                lookup_key(User, "username", previous_username),
+                lookup_key(User, "username", user.username)
+            )
+            user_versions.record(db_user.id, db_user.version)
+            profile_cache.invalidate(db_user.id)
         return db_user
 
 class TokenCRUD:
     @staticmethod
-    async def create_access_token(db: AsyncSession, token: TokenCreate) -> AccessToken:
+    async def create_access_token(db: AsyncSession | ShardedSession, token: TokenCreate) -> AccessToken:
+        db = await user_session(db, user_id=token.user_id, write=True)
         db_token = AccessToken(
-            access_token=token.token, 
+            access_token_digest=token_digest(token.token), 
             expiration_time=datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
             user_id=token.user_id
         )
         db.add(db_token)
-        await db.commit()
-        await db.refresh(db_token)
+        await save(db, db_token)
+        db_token.access_token = token.token
+        return db_token
+
+    @staticmethod
+    async def get_access_token(db: AsyncSession | ShardedSession, token: str, user_id: int | None = None) -> AccessToken | None:
+        # Without the owner's id a sharded lookup has to ask every shard
+        statement = select(AccessToken).filter(AccessToken.access_token_digest == token_digest(token))
+        sessions = [await user_session(db, user_id=user_id)] if user_id is not None else [session for _, session in shard_sessions(db)]
+        db_token = None
+        for session in sessions:
+            db_token = await first(session, statement)
+            if db_token is not None:
+                break
+        await release(db)
         return db_token
     
     @staticmethod
-    async def get_refresh_token_by_userid(db: AsyncSession, user_id: str) -> RefreshToken | None:
-        results = await db.execute(select(RefreshToken).filter(RefreshToken.user_id == user_id))
-        return results.scalars().first()
+    async def get_refresh_token_by_userid(db: AsyncSession | ShardedSession, user_id: str) -> RefreshToken | None:
+        db = await user_session(db, user_id=user_id)
+        db_token = await coalesced_first(db, RefreshToken, lookup_key(RefreshToken, "user_id", user_id), select(RefreshToken).filter(RefreshToken.user_id == user_id))
+        await release(db)
+        return db_token
     
     @staticmethod
-    async def create_refresh_token(db: AsyncSession, token: TokenCreate) -> RefreshToken:
+    async def create_refresh_token(db: AsyncSession | ShardedSession, token: TokenCreate) -> RefreshToken:
+        db = await user_session(db, user_id=token.user_id, write=True)
         db_token = RefreshToken(
             user_id=token.user_id,
-            refresh_token=token.token,
+            refresh_token_digest=token_digest(token.token),
             expiration_time=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         )
         db.add(db_token)
-        await db.commit()
-        await db.refresh(db_token)
+        await save(db, db_token)
+        forget_lookups(lookup_key(RefreshToken, "user_id", token.user_id))
+        db_token.refresh_token = token.token
         return db_token
 
     @staticmethod
-    async def update_refresh_token(db: AsyncSession, token: TokenCreate) -> RefreshToken | None:
-        db_token = await TokenCRUD.get_refresh_token_by_userid(db, token.user_id)
+    async def update_refresh_token(db: AsyncSession | ShardedSession, token: TokenCreate) -> RefreshToken | None:
+        db = await user_session(db, user_id=token.user_id, write=True)
+        db_token = await first(db, select(RefreshToken).filter(RefreshToken.user_id == token.user_id))
         if db_token is not None:
-            db_token.refresh_token = token.token
+            db_token.refresh_token_digest = token_digest(token.token)
             db_token.expiration_time = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-            await db.commit()
-            await db.refresh(db_token)
+            await save(db, db_token)
+            forget_lookups(lookup_key(RefreshToken, "user_id", token.user_id))
+            db_token.refresh_token = token.token
         return db_token
     
     
     @staticmethod
-    async def delete_expired_access_tokens(db: AsyncSession) -> int:
-        result = await db.execute(delete(AccessToken).where(AccessToken.expiration_time < datetime.utcnow()))
-        await db.commit()
-        return result.rowcount
+    async def delete_expired_access_tokens(db: AsyncSession | ShardedSession) -> int:
+        deleted = 0
+        for _, session in shard_sessions(db):
+            result = await session.execute(delete(AccessToken).where(AccessToken.expiration_time < datetime.utcnow()))
+            await commit(session)
+            deleted += result.rowcount
+        return deleted
     
     @staticmethod
-    async def delete_expired_refresh_tokens(db: AsyncSession) -> int:
-        result = await db.execute(delete(RefreshToken).where(RefreshToken.expiration_time < datetime.utcnow()))
-        await db.commit()
-        return result.rowcount
\ No newline at end of file
+    async def delete_expired_refresh_tokens(db: AsyncSession | ShardedSession) -> int:
+        deleted = 0
+        for _, session in shard_sessions(db):
+            result = await session.execute(delete(RefreshToken).where(RefreshToken.expiration_time < datetime.utcnow()))
+            await commit(session)
+            deleted += result.rowcount
+        return deleted
\ No newline at end of file
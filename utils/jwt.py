@@ -1,19 +1,34 @@
+import hashlib
 import os
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 
-from jose import jwt
 from jose import JWTError
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 
+from utils.jwt_backends import create_backend
+
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
 ALGORITHM = os.environ.get("JWT_ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", 1)) #7 days
+JWT_USER_CLAIMS = os.environ.get("JWT_USER_CLAIMS", "true").lower() == "true"
+JWT_TRUSTED_CLAIMS = os.environ.get("JWT_TRUSTED_CLAIMS", "false").lower() == "true"
+JWT_BACKEND = os.environ.get("JWT_BACKEND", "auto")
+
+jwt_backend = create_backend(JWT_BACKEND, SECRET_KEY, ALGORITHM)
 
-def create_access_token(username:str, expires_delta: timedelta = None):
+def create_access_token(
+    username:str, 
+    expires_delta: timedelta = None, 
+    user_id: int | None = None, 
+    email: str | None = None, 
+    version: int | None = None
+):
     if expires_delta is None:
         expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     expire = datetime.now(tz=timezone.utc) + expires_delta
@@ -21,22 +36,79 @@ def create_access_token(username:str, expires_delta: timedelta = None):
         "sub": username,
         "exp": expire
     }
-    encoded_jwt = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    if user_id is not None:
+        payload["uid"] = user_id
+    if email is not None:
+        payload["email"] = email
+    if version is not None:
+        payload["ver"] = version
+    encoded_jwt = jwt_backend.encode(payload)
     return encoded_jwt
 
+def create_user_access_token(user) -> str:
+    if not JWT_USER_CLAIMS:
+        return create_access_token(user.username)
+    return create_access_token(user.username, user_id=user.id, email=user.email, version=user.version)
+
 def create_refresh_token() -> str:
     return str(uuid.uuid4())
 
+def token_digest(token: str) -> bytes:
+    # Tokens are high-entropy, so an unsalted SHA-256 is enough to make stored values useless if leaked
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
 def decode_token(token: str) -> dict:
-    return jwt.decode(token, SECRET_KEY, algorithms=ALGORITHM)
+    return jwt_backend.decode(token)
 
-def get_jwt_username(token: str) -> str | None:
+def get_jwt_claims(token: str) -> dict:
     try:
-        payload = decode_token(token)
-        username = payload.get("sub")
+        return decode_token(token)
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid Credentials")
-    return username
+
+def get_jwt_username(token: str) -> str | None:
+    return get_jwt_claims(token).get("sub")
+
+class UserVersionRegistry:
+    # Process-local record of profile versions changed by this process, used to reject
+    # trusted-claims tokens minted before an update or delete. Entries are dropped once
+    # older than the access token lifetime, when no token from before the change is valid.
+    def __init__(self, ttl_seconds: float = ACCESS_TOKEN_EXPIRE_MINUTES * 60):
+        self.ttl_seconds = ttl_seconds
+        self._versions: OrderedDict[int, tuple[int | None, float]] = OrderedDict()
+
+    def _evict_expired(self) -> None:
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._versions:
+            user_id, (_, recorded_at) = next(iter(self._versions.items()))
+            if recorded_at > cutoff:
+                break
+            del self._versions[user_id]
+
+    def _set(self, user_id: int, version: int | None) -> None:
+        self._versions[user_id] = (version, time.monotonic())
+        self._versions.move_to_end(user_id)
+        self._evict_expired()
+
+    def record(self, user_id: int, version: int) -> None:
+        self._set(user_id, version)
+
+    def revoke(self, user_id: int) -> None:
+        self._set(user_id, None)
+
+    def is_current(self, user_id: int, version: int) -> bool:
+        self._evict_expired()
+        if user_id not in self._versions:
+            return True
+        return self._versions[user_id][0] == version
+
+    def clear(self) -> None:
+        self._versions.clear()
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+user_versions = UserVersionRegistry()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 TokenDependency = Annotated[str, Depends(oauth2_scheme)]
\ No newline at end of file
@@ -0,0 +1,26 @@
+import base64
+import json
+from datetime import datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(order: str, prefix: str | None, key: tuple) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    payload = json.dumps({"o": order, "p": prefix, "k": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, order: str, prefix: str | None) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if payload["o"] != order or payload["p"] != prefix:
+            raise InvalidCursor("Cursor does not match the query")
+        values = payload["k"]
+        if order == "create_time":
+            return (datetime.fromisoformat(values[0]), int(values[1]))
+        if order == "username":
+            return (str(values[0]),)
+        return (int(values[0]),)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise InvalidCursor("Invalid Cursor") from e
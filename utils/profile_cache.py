@@ -0,0 +1,49 @@
+import os
+from collections import OrderedDict
+
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+
+
+def profile_etag(user_id: int, version: int) -> str:
+    # Every profile change bumps users.version, so id and version identify the representation
+    return f'W/"{user_id}-{version}"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # Weak comparison (RFC 9110 13.1.2): W/ prefixes are ignored on both sides
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+class ProfileCache:
+    # Pre-encoded /users/me bodies, one version per user, least recently used evicted first
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._bodies: OrderedDict[int, tuple[int, bytes]] = OrderedDict()
+
+    def get(self, user_id: int, version: int) -> bytes | None:
+        entry = self._bodies.get(user_id)
+        if entry is None or entry[0] != version:
+            return None
+        self._bodies.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, user_id: int, version: int, body: bytes) -> None:
+        self._bodies[user_id] = (version, body)
+        self._bodies.move_to_end(user_id)
+        while len(self._bodies) > self.max_size:
+            self._bodies.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self._bodies.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._bodies.clear()
+
+    def __len__(self) -> int:
+        return len(self._bodies)
+
+profile_cache = ProfileCache()